@@ -22,23 +22,11 @@ def build_word_count_graph(input_stream, text_column='text', count_column='count
             if word:
                 yield {'text': word.lower(), count_column: 1}
 
-    def reducer_count_words(word_dictionary):
-        word_count = Counter()
-
-        for row in word_dictionary:
-            word_count[row['text']] += 1
-
-        for word, count in word_count.items():
-            yield {
-                'text': word,
-                'count': count
-            }
-
     chain = gx.Chain(source=input_stream)
     chain.add_map(mapper_split_text)
+    chain.add_aggregate(['text'], {count_column: gx.agg.count()})
     chain.add_sort(keys=['text'])
-    chain.add_reduce(reducer_count_words, keys=['text'])
-    chain.add_sort(keys=['count'])
+    chain.add_sort(keys=[count_column])
 
     return chain
 
@@ -64,13 +52,6 @@ def build_inverted_index_graph(input_stream, doc_column='doc_id', text_column='t
                     'word': token.lower(),
                 }
 
-    def folder_count_docs(state, record=None):
-        state['docs_count'] += 1
-        return state
-
-    def reducer_unique(group):
-        yield next(group)
-
     def reducer_calc_idf(group):
         counter = 0
         for row in group:
@@ -117,11 +98,10 @@ def build_inverted_index_graph(input_stream, doc_column='doc_id', text_column='t
     split_word.add_map(mapper_tokenizer)
 
     count_docs = gx.Chain(source=input_stream)
-    count_docs.add_fold(folder_count_docs, {'docs_count': 0})
+    count_docs.add_aggregate([], {'docs_count': gx.agg.count()})
 
     count_idf = gx.Chain(source=split_word)
-    count_idf.add_sort(keys=['doc_id', 'word'])
-    count_idf.add_reduce(reducer_unique, keys=['doc_id', 'word'])
+    count_idf.add_distinct(keys=['doc_id', 'word'])
     count_idf.add_join(count_docs, strategy='outer')
     count_idf.add_sort(keys=['word'])
     count_idf.add_reduce(reducer_calc_idf, keys=['word'])
@@ -159,10 +139,6 @@ def build_pmi_graph(input_stream, doc_column='doc_id', text_column='text'):
                     'word': token.lower(),
                 }
 
-    def folder_count_words(state, record=None):
-        state['total_words_count'] += 1
-        return state
-
     def frequency_in_all_docs_reducer(group):
         counter = 0
 
@@ -233,11 +209,12 @@ def build_pmi_graph(input_stream, doc_column='doc_id', text_column='text'):
     split_word = gx.Chain(source=input_stream)
     split_word.add_map(mapper_tokenizer)
     split_word.add_join(doc_ids, strategy='outer')
+    split_word.add_select(['doc_id', 'word'])
     split_word.add_sort(keys=['word'])
     split_word.add_reduce(double_words_reducer, keys=['word'])
 
     count_words_in_all_docs = gx.Chain(source=split_word)
-    count_words_in_all_docs.add_fold(folder_count_words, {'total_words_count': 0})
+    count_words_in_all_docs.add_aggregate([], {'total_words_count': gx.agg.count()})
 
     count_all_docs = gx.Chain(source=split_word)
     count_all_docs.add_join(count_words_in_all_docs, strategy='outer')
@@ -293,28 +270,12 @@ def build_yandex_maps_graph(input_stream, input_stream_length):
             'distance': distance
         }
 
-    def speed_reducer(group):
-        total_distance = 0
-        total_time = 0
-
-        for row in group:
-            total_distance += row['distance']
-            total_time += row['time_lapse']
-            weekday = row['weekday']
-            hour = row['hour']
-
-        yield {
-            'weekday': weekday,
-            'hour': hour,
-            'speed': total_distance / total_time
-        }
-
     times = gx.Chain(source=input_stream)
 
     routes = gx.Chain(source=input_stream_length)
     routes.add_join(times, keys=['edge_id'], strategy='inner')
     routes.add_map(mapper_time_and_distance)
+    routes.add_aggregate(['weekday', 'hour'], {'speed': gx.agg.sum('distance') / gx.agg.sum('time_lapse')})
     routes.add_sort(keys=['weekday', 'hour'])
-    routes.add_reduce(speed_reducer, keys=['weekday', 'hour'])
 
     return routes
@@ -0,0 +1,367 @@
+"""
+Declarative aggregations for *Chain.add_aggregate*.
+
+An aggregation is an expression of aggregates (count, sum, mean, min, max, distinct), constants
+and arithmetic operators, for example agg.sum('distance') / agg.sum('time_lapse'). Aggregates keep mergeable
+states, so they are computed on batches of rows and on partitions of the table and merged afterwards.
+The module is exposed as *graphx.lib.graphx.agg*, so its factories do not shadow the builtins.
+
+Example:
+    chain.add_aggregate(['weekday', 'hour'], {
+        'count': agg.count(),
+        'speed': agg.sum('distance') / agg.sum('time_lapse')
+    })
+"""
+
+import typing
+import builtins
+import operator
+from abc import ABC, abstractmethod
+
+
+class Expression(ABC):
+    """
+    Base class of aggregation expressions, supports +, -, * and / with other expressions and numbers
+    """
+
+    @abstractmethod
+    def aggregates(self) -> list:
+        """
+        Returns aggregates, the expression is built of
+        """
+        pass
+
+    @abstractmethod
+    def evaluate(self, results: dict):
+        """
+        Computes the value of the expression
+
+        :param results: dict, which maps keys of aggregates to their results
+        """
+        pass
+
+    @abstractmethod
+    def to_plan(self) -> dict:
+        """
+        Serializes the expression into a dict, see *expression_from_plan*
+        """
+        pass
+
+    def __add__(self, other):
+        return BinaryExpression('+', self, other)
+
+    def __radd__(self, other):
+        return BinaryExpression('+', other, self)
+
+    def __sub__(self, other):
+        return BinaryExpression('-', self, other)
+
+    def __rsub__(self, other):
+        return BinaryExpression('-', other, self)
+
+    def __mul__(self, other):
+        return BinaryExpression('*', self, other)
+
+    def __rmul__(self, other):
+        return BinaryExpression('*', other, self)
+
+    def __truediv__(self, other):
+        return BinaryExpression('/', self, other)
+
+    def __rtruediv__(self, other):
+        return BinaryExpression('/', other, self)
+
+
+class Constant(Expression):
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return repr(self.value)
+
+    def aggregates(self):
+        return []
+
+    def evaluate(self, results):
+        return self.value
+
+    def to_plan(self):
+        return {'constant': self.value}
+
+
+OPERATORS = {'+': operator.add, '-': operator.sub, '*': operator.mul, '/': operator.truediv}
+
+
+class BinaryExpression(Expression):
+    def __init__(self, operator_name: str, left, right):
+        self.operator_name = operator_name
+        self.left = _expression(left)
+        self.right = _expression(right)
+
+    def __repr__(self):
+        return '({!r} {} {!r})'.format(self.left, self.operator_name, self.right)
+
+    def aggregates(self):
+        return self.left.aggregates() + self.right.aggregates()
+
+    def evaluate(self, results):
+        left = self.left.evaluate(results)
+        right = self.right.evaluate(results)
+        if left is None or right is None:
+            return None
+        return OPERATORS[self.operator_name](left, right)
+
+    def to_plan(self):
+        return {'operator': self.operator_name, 'left': self.left.to_plan(), 'right': self.right.to_plan()}
+
+
+class Aggregate(Expression):
+    """
+    Aggregate of one column (or of rows, if *column* is None). The state of an empty group is *initial()*,
+    *update* adds a batch of values to the state, *merge* combines states of two parts of a group
+    """
+
+    name = None
+
+    def __init__(self, column: str = None):
+        self.column = column
+
+    def __repr__(self):
+        return '{}({})'.format(self.name, repr(self.column) if self.column is not None else '')
+
+    @property
+    def key(self) -> tuple:
+        return self.name, self.column
+
+    def aggregates(self):
+        return [self]
+
+    def evaluate(self, results):
+        return results[self.key]
+
+    def to_plan(self):
+        return {'aggregate': self.name, 'column': self.column}
+
+    @abstractmethod
+    def initial(self):
+        pass
+
+    @abstractmethod
+    def update(self, state, values: list):
+        pass
+
+    @abstractmethod
+    def merge(self, state, other_state):
+        pass
+
+    def result(self, state):
+        return state
+
+
+class Count(Aggregate):
+    name = 'count'
+
+    def initial(self):
+        return 0
+
+    def update(self, state, values):
+        return state + len(values)
+
+    def merge(self, state, other_state):
+        return state + other_state
+
+
+class Sum(Aggregate):
+    name = 'sum'
+
+    def initial(self):
+        return 0
+
+    def update(self, state, values):
+        return builtins.sum(values, state)
+
+    def merge(self, state, other_state):
+        return state + other_state
+
+
+class Mean(Aggregate):
+    name = 'mean'
+
+    def initial(self):
+        return 0, 0
+
+    def update(self, state, values):
+        return builtins.sum(values, state[0]), state[1] + len(values)
+
+    def merge(self, state, other_state):
+        return state[0] + other_state[0], state[1] + other_state[1]
+
+    def result(self, state):
+        return state[0] / state[1] if state[1] else None
+
+
+class Min(Aggregate):
+    name = 'min'
+
+    def initial(self):
+        return None
+
+    def update(self, state, values):
+        return self.merge(state, builtins.min(values) if values else None)
+
+    def merge(self, state, other_state):
+        if state is None or other_state is None:
+            return other_state if state is None else state
+        return builtins.min(state, other_state)
+
+
+class Max(Aggregate):
+    name = 'max'
+
+    def initial(self):
+        return None
+
+    def update(self, state, values):
+        return self.merge(state, builtins.max(values) if values else None)
+
+    def merge(self, state, other_state):
+        if state is None or other_state is None:
+            return other_state if state is None else state
+        return builtins.max(state, other_state)
+
+
+class Distinct(Aggregate):
+    """
+    Number of distinct values in the column
+    """
+
+    name = 'distinct'
+
+    def initial(self):
+        return set()
+
+    def update(self, state, values):
+        state.update(values)
+        return state
+
+    def merge(self, state, other_state):
+        state |= other_state
+        return state
+
+    def result(self, state):
+        return len(state)
+
+
+AGGREGATES = {aggregate_class.name: aggregate_class for aggregate_class in (Count, Sum, Mean, Min, Max, Distinct)}
+
+
+def count() -> Aggregate:
+    """
+    Number of rows
+    """
+    return Count()
+
+
+def sum(column: str) -> Aggregate:
+    """
+    Sum of values in *column*
+    """
+    return Sum(column)
+
+
+def mean(column: str) -> Aggregate:
+    """
+    Mean of values in *column*, None for an empty group
+    """
+    return Mean(column)
+
+
+def min(column: str) -> Aggregate:
+    """
+    Minimum of values in *column*, None for an empty group
+    """
+    return Min(column)
+
+
+def max(column: str) -> Aggregate:
+    """
+    Maximum of values in *column*, None for an empty group
+    """
+    return Max(column)
+
+
+def distinct(column: str) -> Aggregate:
+    """
+    Number of distinct values in *column*
+    """
+    return Distinct(column)
+
+
+def _expression(value) -> Expression:
+    if isinstance(value, Expression):
+        return value
+    if isinstance(value, dict):
+        return expression_from_plan(value)
+    return Constant(value)
+
+
+def expression_from_plan(plan: dict) -> Expression:
+    """
+    Builds the expression from the dict, created by *Expression.to_plan*
+    """
+    if 'aggregate' in plan:
+        return AGGREGATES[plan['aggregate']](plan['column'])
+    if 'operator' in plan:
+        return BinaryExpression(plan['operator'], plan['left'], plan['right'])
+    return Constant(plan['constant'])
+
+
+class Aggregation:
+    """
+    Set of named expressions, computed together. States of all groups are lists, aligned with *aggregates*
+    """
+
+    def __init__(self, expressions: typing.Dict[str, typing.Union[Expression, dict]]):
+        """
+        Construct an Aggregation object
+
+        :param expressions: dict, which maps names of result columns to expressions or their plans
+        """
+        self.expressions = {name: _expression(expression) for name, expression in expressions.items()}
+        unique = {}
+        for expression in self.expressions.values():
+            for aggregate in expression.aggregates():
+                unique.setdefault(aggregate.key, aggregate)
+        self.aggregates = list(unique.values())
+
+    def initial(self) -> list:
+        return [aggregate.initial() for aggregate in self.aggregates]
+
+    def update(self, states: list, rows: list) -> list:
+        """
+        Adds a batch of rows of one group to its states. Values of every column are extracted once
+        """
+        columns = {}
+        for index, aggregate in enumerate(self.aggregates):
+            column = aggregate.column
+            if column is None:
+                values = rows
+            elif column in columns:
+                values = columns[column]
+            else:
+                values = columns[column] = list(map(operator.itemgetter(column), rows))
+            states[index] = aggregate.update(states[index], values)
+        return states
+
+    def merge(self, states: list, other_states: list) -> list:
+        return [
+            aggregate.merge(state, other_state)
+            for aggregate, state, other_state in zip(self.aggregates, states, other_states)
+        ]
+
+    def results(self, states: list) -> dict:
+        results = {aggregate.key: aggregate.result(state) for aggregate, state in zip(self.aggregates, states)}
+        return {name: expression.evaluate(results) for name, expression in self.expressions.items()}
+
+    def to_plan(self) -> dict:
+        return {name: expression.to_plan() for name, expression in self.expressions.items()}
@@ -0,0 +1,47 @@
+"""
+Bloom filter: a compact set, which may report a key, that has never been added, as present,
+but never misses an added key.
+"""
+
+import math
+import typing
+
+
+class BloomFilter:
+    """
+    Bloom filter with *hashes* bit positions per key, derived from two hashes of the key.
+    Keys must be hashable, positions are stable only within one process
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        """
+        Construct a BloomFilter object
+
+        :param capacity: expected number of distinct keys
+        :param error_rate: probability of a false positive, when *capacity* keys are added
+        """
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: typing.Hashable):
+        first = hash(key)
+        second = hash((first, key)) | 1
+        return [(first + index * second) % self.size for index in range(self.hashes)]
+
+    def __contains__(self, key: typing.Hashable) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def add(self, key: typing.Hashable) -> bool:
+        """
+        Adds the key
+
+        :return: True if the key is new, False if it may have been added before
+        """
+        new = False
+        for position in self._positions(key):
+            mask = 1 << (position & 7)
+            if not self._bits[position >> 3] & mask:
+                self._bits[position >> 3] |= mask
+                new = True
+        return new
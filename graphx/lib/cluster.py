@@ -0,0 +1,336 @@
+"""
+Coordinator for the distributed graph execution.
+
+The graph is serialized with Chain.to_plan and executed on workers (see graphx.lib.worker) partition
+by partition. Map, filter and select operations are executed next to the data, reduce and join operations
+hash-partition their inputs by keys, so rows with equal keys meet on the same worker, sorts split their
+inputs into key ranges, so the sorted ranges follow each other. Rows of hot join keys
+are spread over all workers, and the matching rows of the other side are copied to each of them. Folds with
+merge function are folded on every worker and merged on the coordinator. Aggregations are computed
+on every worker into partial states (a combiner), which are shuffled by keys, merged and finalized.
+Distinct rows are found on every worker before the shuffle and once more after it.
+Tables of unions are merged on the coordinator.
+
+Workers do not connect to each other: every exchange goes through the coordinator. Workers send
+rows already split by destination, and the coordinator only forwards them, but the whole table
+of the exchanged step passes through the coordinator's memory and network.
+
+Example:
+    with Cluster(['127.0.0.1:6000', '127.0.0.1:6001']) as cluster:
+        result = cluster.run(chain, docs=docs)
+"""
+
+import json
+import heapq
+import bisect
+import queue
+import typing
+import logging
+import threading
+from collections import Counter
+from operator import itemgetter
+from multiprocessing.connection import Client
+from concurrent.futures import ThreadPoolExecutor
+
+from graphx.lib.graphx import Chain, Operation
+from graphx.lib.worker import environment_authkey, parse_address
+from graphx.lib.partitioning import partition_index
+
+
+ROW_OPERATIONS = ('map', 'filter', 'select')
+
+
+class Cluster:
+    """
+    Executes graphs on a set of workers. Failed tasks are re-run on other workers
+    """
+
+    hot_key_share = 0.5
+    sort_sample_size = 1000
+
+    def __init__(
+            self,
+            addresses: typing.Iterable[typing.Union[str, tuple]],
+            authkey: bytes = None,
+            retries: int = 2
+    ):
+        """
+        Construct a Cluster object
+
+        :param addresses: addresses of workers, 'host:port' strings, (host, port) tuples or Unix socket paths
+        :param authkey (optional): secret key, used to authenticate on workers, defaults to $GRAPHX_AUTHKEY
+        :param retries: number of times a failed task is re-run before the run fails
+        """
+        self._addresses = [parse_address(address) for address in addresses]
+        self._authkey = authkey or environment_authkey()
+        if self._authkey is None:
+            raise ValueError('Authentication key is required, pass authkey or set $GRAPHX_AUTHKEY')
+        self._retries = retries
+        self._connections = {}
+        self._free = queue.Queue()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Closes connections to all workers
+        """
+        with self._lock:
+            for connection in self._connections.values():
+                connection.close()
+            self._connections = {}
+            self._free = queue.Queue()
+
+    def run(self, chain: Chain, **kwargs) -> list:
+        """
+        Runs the graph on workers. All functions of the graph must be importable on workers
+
+        :param chain: prebuilt Chain object
+        :param kwargs: sources of the graph, lists, iterables or opened files
+        :return: list of rows. Row order is defined by the last operation only if it is sort
+        """
+        plan = chain.prepare().to_plan()
+        self._connect()
+        self._partitions = len(self._connections)
+        results = []
+        for chain_plan in plan['chains']:
+            source = chain_plan['source']
+            if 'chain' in source:
+                partitions = results[source['chain']]
+            else:
+                partitions = self._split(_read_input(kwargs[source['input']]))
+            results.append(self._run_operations(chain_plan['operations'], partitions, results, kwargs))
+        return [row for partition in results[plan['output']] for row in partition]
+
+    def _run_operations(self, operations, partitions, results, inputs):
+        pending = []
+        for operation in operations:
+            logging.info('Executing operation %s', operation['operation'])
+            if operation['operation'] in ROW_OPERATIONS:
+                pending.append(operation)
+            elif operation['operation'] == 'sort':
+                if operation['keys']:
+                    partitions = self._split_ranges(
+                        self._flush(pending, partitions), operation['keys'], operation['reverse']
+                    )
+                    partitions = self._execute([_task([operation], partition) for partition in partitions])
+                else:
+                    partitions = self._execute([_task(pending + [operation], partition) for partition in partitions])
+            elif operation['operation'] == 'reduce':
+                partitions = self._shuffle(pending, partitions, operation['keys'])
+                reduce_operations = [operation]
+                if operation['keys']:
+                    reduce_operations.insert(0, {'operation': 'sort', 'keys': operation['keys'], 'reverse': False})
+                partitions = self._execute([_task(reduce_operations, partition) for partition in partitions])
+            elif operation['operation'] == 'distinct':
+                partitions = self._shuffle(pending + [operation], partitions, operation['keys'])
+                final = dict(operation, presorted=False)
+                partitions = self._execute([_task([final], partition) for partition in partitions])
+            elif operation['operation'] == 'aggregate':
+                partial = dict(operation, phase='partial')
+                partitions = self._shuffle(pending + [partial], partitions, operation['keys'])
+                final = dict(operation, phase='final')
+                partitions = self._execute([_task([final], partition) for partition in partitions])
+            elif operation['operation'] == 'fold' and operation.get('merge_function') is not None:
+                partitions = [partition for partition in self._flush(pending, partitions) if partition] or [[]]
+                states = self._execute([_task([dict(operation, workers=1)], partition) for partition in partitions])
+                partitions = [[Operation.from_plan(operation).merge([state for state, in states])]]
+            elif operation['operation'] == 'fold':
+                table = [row for partition in self._flush(pending, partitions) for row in partition]
+                partitions = self._execute([_task([operation], table)])
+            elif operation['operation'] == 'join':
+                on = operation['on']
+                right_partitions = results[on['chain']] if 'chain' in on else self._split(on['table'])
+                left_partitions = self._shuffle(pending, partitions, operation['keys'])
+                right_partitions = self._shuffle([], right_partitions, operation['keys'])
+                left_partitions, right_partitions = self._split_hot_keys(
+                    left_partitions, right_partitions, operation['keys']
+                )
+                partitions = self._execute([
+                    _task([dict(operation, on=right)], left)
+                    for left, right in zip(left_partitions, right_partitions)
+                ])
+            elif operation['operation'] == 'union':
+                tables = [[row for partition in self._flush(pending, partitions) for row in partition]]
+                for source in operation['sources']:
+                    if 'chain' in source:
+                        tables.append([row for partition in results[source['chain']] for row in partition])
+                    else:
+                        tables.append(_read_input(inputs[source['input']]))
+                if operation['sorted_by'] is not None:
+                    sorted_by = operation['sorted_by']
+                    table = list(heapq.merge(*tables, key=lambda row: [row[key] for key in sorted_by]))
+                else:
+                    table = [row for source_table in tables for row in source_table]
+                partitions = self._split(table)
+            else:
+                raise ValueError('Unknown operation {!r}'.format(operation['operation']))
+            if operation['operation'] not in ROW_OPERATIONS:
+                pending = []
+        return self._flush(pending, partitions)
+
+    def _flush(self, pending, partitions):
+        if not pending:
+            return partitions
+        return self._execute([_task(pending, partition) for partition in partitions])
+
+    def _shuffle(self, pending, partitions, keys):
+        count = self._partitions
+        if pending:
+            tasks = [
+                dict(_task(pending, partition), partition={'keys': list(keys), 'count': count})
+                for partition in partitions
+            ]
+            buckets = self._execute(tasks)
+        else:
+            buckets = []
+            for partition in partitions:
+                partition_buckets = [[] for _ in range(count)]
+                for row in partition:
+                    partition_buckets[partition_index(row, keys, count)].append(row)
+                buckets.append(partition_buckets)
+        return [[row for partition_buckets in buckets for row in partition_buckets[index]] for index in range(count)]
+
+    def _split_ranges(self, partitions, keys, reverse):
+        """
+        Splits rows into key ranges, chosen by a sample of keys, so sorted ranges are parts of the sorted table.
+        Rows with equal keys get into the same range in their original order
+        """
+        key = itemgetter(*keys)
+        total = sum(len(partition) for partition in partitions)
+        if total == 0:
+            return partitions
+        step = max(total // self.sort_sample_size, 1)
+        sample = sorted(key(row) for partition in partitions for row in partition[::step])
+        boundaries = [sample[len(sample) * index // self._partitions] for index in range(1, self._partitions)]
+        ranges = [[] for _ in range(self._partitions)]
+        for partition in partitions:
+            for row in partition:
+                ranges[bisect.bisect_right(boundaries, key(row))].append(row)
+        if reverse:
+            ranges.reverse()
+        return ranges
+
+    def _split_hot_keys(self, left_partitions, right_partitions, keys):
+        """
+        Finds keys, which have more rows on one side than *hot_key_share* of an average partition.
+        Rows of such a key on that side are spread over all partitions, rows of the key on the other side
+        are copied to every partition
+        """
+        count = self._partitions
+        left_counts = Counter(_key(row, keys) for partition in left_partitions for row in partition)
+        right_counts = Counter(_key(row, keys) for partition in right_partitions for row in partition)
+        left_limit = max(self.hot_key_share * sum(left_counts.values()) / count, count)
+        right_limit = max(self.hot_key_share * sum(right_counts.values()) / count, count)
+        left_hot_keys = set()
+        right_hot_keys = set()
+        for key in left_counts.keys() & right_counts.keys():
+            if left_counts[key] >= right_counts[key] and left_counts[key] > left_limit:
+                left_hot_keys.add(key)
+            elif right_counts[key] > left_counts[key] and right_counts[key] > right_limit:
+                right_hot_keys.add(key)
+        if count < 2 or not left_hot_keys and not right_hot_keys:
+            return left_partitions, right_partitions
+        logging.info('Hot keys %s are split between workers', sorted(left_hot_keys | right_hot_keys, key=repr))
+        return (
+            self._redistribute(left_partitions, keys, left_hot_keys, right_hot_keys),
+            self._redistribute(right_partitions, keys, right_hot_keys, left_hot_keys)
+        )
+
+    def _redistribute(self, partitions, keys, spread_keys, copy_keys):
+        result = [[] for _ in range(self._partitions)]
+        turns = Counter()
+        for index, partition in enumerate(partitions):
+            for row in partition:
+                key = _key(row, keys)
+                if key in spread_keys:
+                    result[turns[key] % self._partitions].append(row)
+                    turns[key] += 1
+                elif key in copy_keys:
+                    for result_partition in result:
+                        result_partition.append(row)
+                else:
+                    result[index].append(row)
+        return result
+
+    def _split(self, table):
+        size = -(-len(table) // self._partitions) or 1
+        return [table[index * size:(index + 1) * size] for index in range(self._partitions)]
+
+    def _connect(self):
+        with self._lock:
+            for address in self._addresses:
+                if address in self._connections:
+                    continue
+                try:
+                    connection = Client(address, authkey=self._authkey)
+                except (OSError, EOFError):
+                    logging.warning('Worker %s is not available', address)
+                    continue
+                self._connections[address] = connection
+                self._free.put(address)
+            if not self._connections:
+                raise RuntimeError('No workers available')
+
+    def _acquire(self):
+        while True:
+            with self._lock:
+                if not self._connections:
+                    raise RuntimeError('No workers available')
+            try:
+                address = self._free.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            with self._lock:
+                if address in self._connections:
+                    return address, self._connections[address]
+
+    def _discard(self, address):
+        with self._lock:
+            connection = self._connections.pop(address, None)
+        if connection is not None:
+            connection.close()
+
+    def _execute(self, tasks):
+        with ThreadPoolExecutor(max_workers=max(len(self._connections), 1)) as executor:
+            return list(executor.map(self._execute_task, tasks))
+
+    def _execute_task(self, task):
+        error = None
+        for _ in range(self._retries + 1):
+            address, connection = self._acquire()
+            try:
+                connection.send(task)
+                status, result = connection.recv()
+            except (OSError, EOFError) as exc:
+                logging.warning('Worker %s failed, re-running the task', address)
+                self._discard(address)
+                error = repr(exc)
+                continue
+            self._free.put(address)
+            if status == 'ok':
+                return result
+            logging.warning('Task failed on worker %s, re-running it', address)
+            error = result
+        raise RuntimeError('Task failed after {} attempts:\n{}'.format(self._retries + 1, error))
+
+
+def _task(operations, table):
+    return {'operations': operations, 'table': table}
+
+
+def _key(row, keys):
+    return tuple(row[key] for key in keys)
+
+
+def _read_input(input_stream):
+    if isinstance(input_stream, list):
+        return input_stream
+    if hasattr(input_stream, 'read'):
+        return [json.loads(line) for line in input_stream]
+    return list(input_stream)
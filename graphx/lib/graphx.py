@@ -1,19 +1,34 @@
-import json
+import os
 import sys
+import json
+import pickle
 import typing
+import heapq
 import logging
-from functools import reduce
+import itertools
+import importlib
+from functools import reduce, partial
 from copy import deepcopy
+from datetime import datetime, timedelta
 from pprint import pprint
 from itertools import groupby
-from collections.abc import Iterator
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from abc import ABC, abstractmethod
 from operator import itemgetter
 
+from graphx.lib.pipeline import Pipeline
+from graphx.lib.bloom import BloomFilter
+from graphx.lib.memory import MemoryGovernor, SpillBuffer, ExternalSorter, SpillSet
+from graphx.lib.stats import TableStats, CostModel
+from graphx.lib import aggregates as agg
+from graphx.lib.aggregates import Aggregation
+
 
 class Chain:
     """
-    Basic class for graph computations. Supports operations *map*, *reduce*, *sort*, *fold* and *join*.
+    Basic class for graph computations. Supports operations *map*, *filter*, *select*, *distinct*, *reduce*,
+    *aggregate*, *sort*, *fold*, *join* and *union*.
     """
 
     def __init__(self, source: typing.Union[typing.TypeVar('Chain'), str]):
@@ -24,12 +39,22 @@ class Chain:
         """
         self._source = source
         self._operations = []
-        self._table = []
-        self._launches = 0
-        self._max_launches = 0
-        self._kwargs = {}
-        if isinstance(self._source, Chain):
-            self._source._max_launches += 1
+        self._pipeline = None
+        self._version = 0
+        self._prepared = None
+        self._prepared_versions = None
+        self._profile = None
+        self.memory_report = None
+
+    def __deepcopy__(self, memo):
+        """
+        Copies the graph without the cached prepared graph of *run*
+        """
+        chain = self.__class__.__new__(self.__class__)
+        memo[id(self)] = chain
+        for name, value in self.__dict__.items():
+            chain.__dict__[name] = None if name == '_prepared' else deepcopy(value, memo)
+        return chain
 
     def add_map(self, mapper_function: typing.Generator):
         """
@@ -43,6 +68,32 @@ class Chain:
                 yield row
         """
         self._operations.append(MapOperation(mapper_function=mapper_function))
+        self._version += 1
+        return deepcopy(self)
+
+    def add_filter(self, predicate: typing.Callable):
+        """
+        Adds filter operation to the graph. Filters are moved before sorts, when the graph is run
+
+        :param predicate: function, takes one row, returns True if the row is kept
+
+        Example:
+            def predicate_long_word(row):
+                return len(row['word']) > 4
+        """
+        self._operations.append(FilterOperation(predicate=predicate))
+        self._version += 1
+        return deepcopy(self)
+
+    def add_select(self, columns: typing.Union[list, tuple]):
+        """
+        Adds projection to the graph: only *columns* of every row are kept. Projections are moved
+        before sorts and filters, when the graph is run, so sorted rows are narrower
+
+        :param columns: names of columns to keep
+        """
+        self._operations.append(SelectOperation(columns=list(columns)))
+        self._version += 1
         return deepcopy(self)
 
     def add_sort(self, keys: typing.Union[list, tuple], reverse: bool = False):
@@ -53,24 +104,46 @@ class Chain:
         :param reverse: if True, sort is done in reversed order
         """
         self._operations.append(SortOperation(keys=keys, reverse=reverse))
+        self._version += 1
         return deepcopy(self)
 
-    def add_fold(self, folder_function: typing.Callable, initial_state: dict = None):
+    def add_fold(
+            self,
+            folder_function: typing.Callable,
+            initial_state: dict = None,
+            merge_function: typing.Callable = None,
+            workers: int = None
+    ):
         """
         Adds fold operation to the graph
 
-        :param initial_state (optional): if provided, folder function takes this as an initial value
+        :param initial_state (optional): if provided, folder function takes a copy of this as an initial value
         :param folder_function: function, takes one row, yields one row
+        :param merge_function (optional): function, takes two states, returns the merged state. If provided,
+            the table is folded by partitions in parallel processes and partial states are merged in a tree.
+            Functions must be picklable, that is defined at module level
+        :param workers (optional): number of processes for the parallel fold, defaults to the number of CPUs
 
         Example:
             def folder_sum_columnwise(state, record):
                 for column in state:
                     state[column] += record[column]
                 return state
+
+            def merge_sum_columnwise(state, other_state):
+                for column in state:
+                    state[column] += other_state[column]
+                return state
         """
         self._operations.append(
-            FoldOperation(folder_function=folder_function, initial_state=initial_state)
+            FoldOperation(
+                folder_function=folder_function,
+                initial_state=initial_state,
+                merge_function=merge_function,
+                workers=workers
+            )
         )
+        self._version += 1
         return deepcopy(self)
 
     def add_reduce(self, reducer_function: typing.Generator, keys: typing.Union[list, tuple]):
@@ -98,6 +171,55 @@ class Chain:
 
         """
         self._operations.append(ReduceOperation(reducer_function=reducer_function, keys=keys))
+        self._version += 1
+        return deepcopy(self)
+
+    def add_aggregate(self, keys: typing.Union[list, tuple], aggregations: dict):
+        """
+        Adds aggregation to the graph. Rows are grouped by *keys*, the table need not be sorted.
+        For every group one row with *keys* columns and computed *aggregations* is yielded,
+        with empty *keys* the whole table is one group
+
+        :param keys: keys to be used in grouping
+        :param aggregations: dict, which maps result columns to expressions of aggregates
+            (*agg.count*, *agg.sum*, *agg.mean*, *agg.min*, *agg.max*, *agg.distinct*), numbers and operators +, -, *, /
+
+        Example:
+            chain.add_aggregate(['weekday', 'hour'], {'speed': agg.sum('distance') / agg.sum('time_lapse')})
+        """
+        self._operations.append(AggregateOperation(keys=list(keys), aggregations=aggregations))
+        self._version += 1
+        return deepcopy(self)
+
+    def add_distinct(
+            self,
+            keys: typing.Union[list, tuple],
+            approximate: bool = False,
+            capacity: int = 1000000,
+            error_rate: float = 0.01,
+            presorted: bool = False
+    ):
+        """
+        Adds distinct operation to the graph: only the first row of every set of values in *keys* columns
+        is kept. Rows are streamed, the table need not be sorted. If the table is sorted by *keys*, only the
+        previous key is kept in memory, otherwise keys are kept in a hash set, which is spilled to disk
+        under the memory limit
+
+        :param keys: keys to be used in deduplication
+        :param approximate (optional): if True, keys are kept in a Bloom filter of fixed size. Some rows
+            with new keys (about *error_rate* of them) are dropped as duplicates
+        :param capacity (optional): expected number of distinct keys for the Bloom filter
+        :param error_rate (optional): probability of dropping a row with a new key for the Bloom filter
+        :param presorted (optional): if True, the table is trusted to be sorted by *keys*
+        """
+        self._operations.append(DistinctOperation(
+            keys=list(keys),
+            approximate=approximate,
+            capacity=capacity,
+            error_rate=error_rate,
+            presorted=presorted
+        ))
+        self._version += 1
         return deepcopy(self)
 
     def add_join(
@@ -119,128 +241,1181 @@ class Chain:
             'outer' -- executes both left and right strategies
         """
         self._operations.append(JoinOperation(on=on, keys=keys, strategy=strategy))
-        if isinstance(on, Chain):
-            on._max_launches += 1
+        self._version += 1
+        return deepcopy(self)
+
+    def add_union(
+            self,
+            *sources: typing.Union[typing.TypeVar('Chain'), str],
+            sorted_by: typing.Union[list, tuple] = None
+    ):
+        """
+        Appends tables of *sources* to the current graph table. If *sorted_by* is provided, all tables
+        must be sorted by these keys, and they are merged into one table, sorted by them.
+        Following sort by *sorted_by* and reduce and join by these keys do not sort the table again
+
+        :param sources: prebuilt Chain objects or names of sources
+        :param sorted_by (optional): keys, all tables are sorted by
+
+        Example:
+            chain = Chain(source='monday')
+            chain.add_union('tuesday', 'wednesday', sorted_by=['edge_id'])
+        """
+        self._operations.append(UnionOperation(
+            sources=list(sources),
+            sorted_by=list(sorted_by) if sorted_by is not None else None
+        ))
+        self._version += 1
+        return deepcopy(self)
+
+    def add_window_reduce(
+            self,
+            reducer_function: typing.Generator,
+            keys: typing.Union[list, tuple],
+            time_column: str,
+            window: typing.Tuple[float, float],
+            allowed_lateness: float = 0
+    ):
+        """
+        Adds event-time window reduce operation to the graph. Rows are grouped by window and by *keys*,
+        the table need not be sorted. A window is reduced and emitted as soon as the watermark (the greatest
+        seen value in *time_column* minus *allowed_lateness*) passes its end. Rows of already emitted
+        windows are dropped. Every resulting row gets *window_start* and *window_end* columns of the type
+        of *time_column*. Windows of datetimes are aligned by their wall time, not by the time zone of the process
+
+        :param reducer_function: generator, takes rows of one window with the same value in *keys*, yields rows
+        :param keys: keys to be used in grouping
+        :param time_column: column with event time, number of seconds or datetime
+        :param window: window, created by *tumbling_window* or *sliding_window*
+        :param allowed_lateness: number of seconds or timedelta, by which rows can be late
+
+        Example:
+            chain.add_window_reduce(speed_reducer, ['weekday', 'hour'], 'enter_time', tumbling_window(60))
+        """
+        self._operations.append(WindowReduceOperation(
+            reducer_function=reducer_function,
+            keys=keys,
+            time_column=time_column,
+            window=window,
+            allowed_lateness=_seconds(allowed_lateness)
+        ))
+        self._version += 1
+        return deepcopy(self)
+
+    def enable_pipeline(self, queue_depth: int = 8, batch_size: int = 1024):
+        """
+        Runs every operation of the chain in its own thread. Operations pass batches of rows to each other
+        through bounded queues, so I/O and functions, which release the GIL, overlap
+
+        :param queue_depth: maximum number of batches, waiting between two operations
+        :param batch_size: maximum number of rows in a batch
+        """
+        self._pipeline = {'queue_depth': queue_depth, 'batch_size': batch_size}
+        self._version += 1
         return deepcopy(self)
 
-    def run(self, output_stream: typing.TextIO = None, verbose: bool = False, debug: bool = False, **kwargs):
+    def _graph(self):
+        """
+        Returns chains of the graph in the execution order (sources before their consumers)
+        and the number of consumers of every chain
+        """
+        chains = []
+        consumers = Counter()
+
+        def visit(chain):
+            consumers[id(chain)] += 1
+            if consumers[id(chain)] > 1:
+                return
+            if isinstance(chain._source, Chain):
+                visit(chain._source)
+            for operation in chain._operations:
+                for other_chain in operation.chains():
+                    visit(other_chain)
+            chains.append(chain)
+
+        visit(self)
+        return chains, consumers
+
+    def _ordering(self):
+        """
+        Returns keys, the table of the chain is known to be sorted by, or None
+        """
+        ordering = self._source._ordering() if isinstance(self._source, Chain) else None
+        for operation in self._operations:
+            ordering = operation.ordering(ordering)
+        return ordering
+
+    def to_plan(self) -> dict:
+        """
+        Serializes the graph into a plan built of plain data structures. User functions are referenced
+        by importable name ('module:qualname'), so they must be defined at module level
+
+        Chains are listed in the execution order, shared chains appear only once. Sources and joins refer
+        to other chains by their index in *chains*.
+        """
+        chains, _ = self._graph()
+        indices = {id(chain): index for index, chain in enumerate(chains)}
+        chain_plans = []
+        for chain in chains:
+            if isinstance(chain._source, Chain):
+                source = {'chain': indices[id(chain._source)]}
+            else:
+                source = {'input': chain._source}
+            operations = []
+            for operation in chain._operations:
+                operation_plan = operation.to_plan()
+                if isinstance(operation, JoinOperation):
+                    on = operation.kwargs['on']
+                    operation_plan['on'] = {'chain': indices[id(on)]} if isinstance(on, Chain) else {'table': list(on)}
+                elif isinstance(operation, UnionOperation):
+                    operation_plan['sources'] = [
+                        {'chain': indices[id(source)]} if isinstance(source, Chain) else {'input': source}
+                        for source in operation.kwargs['sources']
+                    ]
+                operations.append(operation_plan)
+            chain_plans.append({'source': source, 'operations': operations})
+        return {'chains': chain_plans, 'output': indices[id(self)]}
+
+    @staticmethod
+    def from_plan(plan: dict):
+        """
+        Builds the graph from the plan, created by *to_plan*
+
+        :param plan: dict with *chains* and *output* fields
+        :return: Chain object, corresponding to the *output* chain of the plan
+        """
+        chains = []
+        for chain_plan in plan['chains']:
+            source = chain_plan['source']
+            chain = Chain(source=chains[source['chain']] if 'chain' in source else source['input'])
+            for operation_plan in chain_plan['operations']:
+                operation_plan = dict(operation_plan)
+                if operation_plan['operation'] == 'join':
+                    on = operation_plan['on']
+                    operation_plan['on'] = chains[on['chain']] if 'chain' in on else on['table']
+                elif operation_plan['operation'] == 'union':
+                    operation_plan['sources'] = [
+                        chains[source['chain']] if 'chain' in source else source['input']
+                        for source in operation_plan['sources']
+                    ]
+                chain._operations.append(Operation.from_plan(operation_plan))
+            chains.append(chain)
+        return chains[plan['output']]
+
+    def stream(self, **kwargs) -> typing.Iterator:
+        """
+        Runs the predefined graph over possibly unbounded sources. Rows are yielded as soon as they are
+        computed, so only operations, which do not need the whole table (map and window reduce), are allowed
+
+        :param kwargs: *kwargs[source]* is IO object or iterable
+        :return: iterator over the resulting rows
+        """
+        for operation in self._operations:
+            if not operation.streaming:
+                raise ValueError('Operation {!r} can not be executed in streaming mode'.format(operation.name))
+        if isinstance(self._source, Chain):
+            table = self._source.stream(**kwargs)
+        else:
+            table = _read_table(kwargs[self._source])
+        for operation in self._operations:
+            table = operation.run(table)
+        return iter(table)
+
+    def prepare(self, verbose: bool = False, debug: bool = False):
+        """
+        Freezes the graph for repeated runs. Later changes of the chain do not affect the prepared graph
+
+        :param verbose (optional): boolean. If True logs all operations
+        :param debug (optional): boolean. If True debug logging is on
+        :return: PreparedChain object
+        """
+        _configure_logging(verbose, debug)
+        return PreparedChain(_copy_graph(self))
+
+    def _prepare(self):
+        """
+        Returns the prepared copy of the graph for *run*. It is built again only if some chain of the graph
+        has been changed since the previous call
+        """
+        chains, _ = self._graph()
+        versions = [(id(chain), chain._version) for chain in chains]
+        if self._prepared is None or self._prepared_versions != versions:
+            self._prepared = PreparedChain(_copy_graph(self))
+            self._prepared_versions = versions
+        return self._prepared
+
+    def run(
+            self,
+            output_stream: typing.TextIO = None,
+            verbose: bool = False,
+            debug: bool = False,
+            memory_limit: int = None,
+            profile: bool = False,
+            **kwargs
+    ):
         """
         Runs the predefined graph
 
         :param output_stream (optional): IO object. If provided writes the computed table into it
         :param verbose (optional): boolean. If True logs all operations
+        :param memory_limit (optional): approximate memory budget in bytes. If exceeded, sorts, joins and
+            shared tables spill rows to disk. The report is saved to *memory_report*
+        :param profile (optional): boolean. If True collects statistics and numbers of rows for *explain*
         :param kwargs: *kwargs[source]* is IO object or list
+        :return: RunResult object, the list of rows
         """
-        self._table = []
-        self._launches = 0
-        if debug:
-            logging.basicConfig(
-                format='%(asctime)s - %(levelname)s - %(message)s',
-                level=logging.DEBUG
-            )
-        elif verbose:
-            logging.basicConfig(
-                format='%(asctime)s - %(levelname)s - %(message)s',
-                level=logging.INFO
-            )
-        else:
-            logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s')
-        run_result = self._run(output_stream, verbose, **kwargs)
-        del self._table
-        return run_result
+        _configure_logging(verbose, debug)
+        result = self._prepare().run(output_stream, memory_limit=memory_limit, profile=profile, **kwargs)
+        self.memory_report = result.memory_report
+        self._profile = result.profile
+        return result
+
+    def explain(self) -> str:
+        """
+        Returns the optimized plan of the graph: chains in the execution order and their operations. After *run*
+        returns the plan of the last run, with *profile* operations are annotated with algorithms, chosen
+        by the cost model (e.g. hash or merge join), estimated and actual numbers of rows
+        """
+        prepared = self._prepare()
+        return _explain(prepared._chain, prepared._names, self._profile)
 
-    def _run(self, output_stream=None, verbose=False, **kwargs):
+    def _run(self, context):
         logging.info('Executing run')
-        logging.debug('Current launches: %d', self._launches)
-        logging.debug('Max launches: %d', self._max_launches)
-        self._launches += 1
-        if self._launches == 1:
-            logging.debug('Kwargs:')
-            logging.debug(str(kwargs))
-            if self._source in kwargs.keys():
-                input_stream = kwargs[self._source]
-            elif isinstance(self._source, Chain):
-                input_stream = self._source._run(verbose=verbose, **kwargs)
-            self._kwargs = kwargs
-            self._load_table(input_stream)
+        context.launches[id(self)] += 1
+        logging.debug('Current launches: %d', context.launches[id(self)])
+        logging.debug('Max launches: %d', context.consumers[id(self)])
+        if id(self) in context.tables:
+            logging.info('Table has already been computed')
+            table = context.tables[id(self)]
+        else:
+            logging.debug('Kwargs: %s', context.inputs)
+            if isinstance(self._source, Chain):
+                input_stream = self._source._run(context)
+            else:
+                input_stream = context.inputs[self._source]
+            table = _read_table(input_stream)
+            logging.info('Table loaded')
+            stats = None
+            if context.collect_stats:
+                stats = context.stats.get(id(self._source)) if isinstance(self._source, Chain) else None
+                if stats is None and _is_materialized(table):
+                    stats = TableStats.from_table(table)
+            pipeline = Pipeline(**self._pipeline) if self._pipeline else None
+            if pipeline:
+                table = pipeline.stage(iter, table)
+            ordering = self._source._ordering() if isinstance(self._source, Chain) else None
             for operation in self._operations:
                 logging.info('Executing operation %s', repr(operation))
-                self._table = operation.run(self._table, verbose=verbose, **kwargs)
+                context.orderings[id(operation)] = ordering
+                ordering = operation.ordering(ordering)
+                if context.collect_stats:
+                    entry = context.profile[id(operation)] = {'input_stats': stats}
+                    stats = operation.estimate(stats, context)
+                    entry['estimated_rows'] = stats.rows if stats is not None else None
+                if pipeline:
+                    table = pipeline.stage(partial(operation.run, context=context), table)
+                else:
+                    table = operation.run(table, context)
+                if context.profiling:
+                    if isinstance(table, list):
+                        entry['actual_rows'] = len(table)
+                    else:
+                        table = _counted(table, entry)
                 logging.info('Operation %s successfully executed', repr(operation))
-        else:
-            logging.info('Table has already been computed')
+            try:
+                if context.governor is not None:
+                    table = SpillBuffer(context.governor, 'table of {}'.format(context.names[id(self)]), table)
+                else:
+                    table = list(table)
+            except BaseException:
+                if pipeline:
+                    pipeline.cancel()
+                raise
+            if context.collect_stats and context.consumers[id(self)] > 1:
+                context.stats[id(self)] = TableStats.from_table(table)
+            context.tables[id(self)] = table
+        if context.launches[id(self)] >= context.consumers[id(self)]:
+            del context.tables[id(self)]
+        return table
+
+
+class PreparedChain:
+    """
+    Frozen graph, which can be run many times, also concurrently. Every run has its own state
+    """
+
+    def __init__(self, chain: Chain):
+        """
+        Construct a PreparedChain object
+
+        :param chain: Chain object, which must not be changed while the prepared graph is used
+        """
+        self._chain = chain
+        chains, self._consumers = chain._graph()
+        self._names = {id(chain): 'chain {}'.format(index) for index, chain in enumerate(chains)}
+        self.sources = {chain._source for chain in chains if not isinstance(chain._source, Chain)}
+        for graph_chain in chains:
+            graph_chain._operations = _optimize(graph_chain._operations)
+            for operation in graph_chain._operations:
+                self.sources.update(operation.source_names())
+
+    def run(
+            self,
+            output_stream: typing.TextIO = None,
+            memory_limit: int = None,
+            profile: bool = False,
+            **kwargs
+    ) -> 'RunResult':
+        """
+        Runs the graph. The state of the run, its memory report and profile belong to the run,
+        so concurrent runs do not mix them
+
+        :param output_stream (optional): IO object. If provided writes the computed table into it
+        :param memory_limit (optional): approximate memory budget in bytes. If exceeded, sorts, joins and
+            shared tables spill rows to disk. The report is saved to *memory_report* of the result
+        :param profile (optional): boolean. If True collects statistics and numbers of rows for *explain*
+            of the result
+        :param kwargs: *kwargs[source]* is IO object or list
+        :return: RunResult object, the list of rows
+        """
+        missing_sources = self.sources - kwargs.keys()
+        if missing_sources:
+            raise ValueError('Sources {} are not provided'.format(sorted(missing_sources)))
+        governor = MemoryGovernor(memory_limit) if memory_limit is not None else None
+        context = _Run(kwargs, self._consumers, self._names, governor, profile)
+        result = RunResult(self._chain._run(context))
+        result._prepared = self
+        result.profile = context.profile if profile else None
+        if governor is not None:
+            result.memory_report = governor.report()
+            logging.info('Memory report: %s', result.memory_report)
         if output_stream:
-            pprint(self._table, stream=output_stream)
-        self._table = list(self._table)
-        return self._table
+            pprint(list(result), stream=output_stream)
+        return result
+
+    def explain(self) -> str:
+        """
+        Returns the optimized plan of the graph. Strategies and numbers of rows of a run are shown
+        by *RunResult.explain*
+        """
+        return _explain(self._chain, self._names)
+
+    def to_plan(self) -> dict:
+        """
+        Serializes the optimized graph, see *Chain.to_plan*
+        """
+        return self._chain.to_plan()
+
+    def run_many(self, inputs: typing.Iterable[dict], workers: int = 1) -> typing.Iterator[list]:
+        """
+        Runs the graph on every set of sources in *inputs*
+
+        :param inputs: iterable of dicts, which map source names to sources
+        :param workers (optional): number of runs, executed concurrently in threads
+        :return: iterator over results in the order of *inputs*
+        """
+        if workers <= 1:
+            for kwargs in inputs:
+                yield self.run(**kwargs)
+            return
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = deque()
+            for kwargs in inputs:
+                futures.append(executor.submit(self.run, **kwargs))
+                if len(futures) >= 2 * workers:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
 
-    def _load_table(self, input_stream):
-        if isinstance(input_stream, list):
-            self._table = iter(input_stream)
-        elif hasattr(input_stream, 'read'):
-            for line in input_stream:
-                self._table.append(json.loads(line))
-        elif isinstance(input_stream, Iterator):
-            self._table = input_stream
-        logging.info('Table loaded')
+
+class RunResult(list):
+    """
+    Resulting table of one run: the list of rows with the memory report and the profile of the run
+    """
+
+    memory_report = None
+    profile = None
+    _prepared = None
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+    def explain(self) -> str:
+        """
+        Returns the plan of the graph. If the run was profiled, operations are annotated with strategies,
+        chosen by the cost model, estimated and actual numbers of rows
+        """
+        return _explain(self._prepared._chain, self._prepared._names, self.profile)
+
+
+class _Run:
+    """
+    State of one run: sources, tables of shared chains, numbers of their launches, the memory governor,
+    orders of input tables of operations, statistics of computed tables and the profile of operations.
+    Statistics are collected only if the cost model needs them (under a memory limit) or for the profile
+    """
+
+    def __init__(self, inputs, consumers, names, governor=None, profile=False):
+        self.inputs = inputs
+        self.consumers = consumers
+        self.names = names
+        self.governor = governor
+        self.cost_model = CostModel(governor.limit if governor is not None else None)
+        self.profiling = profile
+        self.collect_stats = profile or governor is not None
+        self.launches = Counter()
+        self.tables = {}
+        self.orderings = {}
+        self.stats = {}
+        self.profile = {}
+
+
+STATES_COLUMN = '__states__'
+
+
+def _copy_graph(chain):
+    """
+    Returns a deep copy of the graph. Static tables of joins are shared with the original, not copied
+    """
+    chains, _ = chain._graph()
+    memo = {}
+    for graph_chain in chains:
+        for operation in graph_chain._operations:
+            on = operation.kwargs.get('on')
+            if isinstance(on, list):
+                memo[id(on)] = on
+    return deepcopy(chain, memo)
+
+
+def _optimize(operations):
+    """
+    Returns the equivalent list of operations, where filters and projections are moved closer to the source.
+    The list of the chain is not changed
+    """
+    operations = list(operations)
+    changed = True
+    while changed:
+        changed = False
+        for index in range(len(operations) - 1):
+            previous = next(
+                (operation for operation in reversed(operations[:index]) if not isinstance(operation, FilterOperation)),
+                None
+            )
+            rewritten = _rewrite(previous, operations[index], operations[index + 1])
+            if rewritten is not None:
+                operations[index:index + 2] = rewritten
+                changed = True
+                break
+    return operations
+
+
+def _rewrite(previous, first, second):
+    """
+    Returns operations, which replace the pair *first*, *second*, or None if the pair is kept.
+    *previous* is the last operation before the pair, which is not a filter.
+    Filters are not moved before projections: the predicate may read columns, which the projection drops.
+    Rules:
+        select, select -> select of common columns
+        sort, filter   -> filter, sort
+        sort, select   -> select, sort if the sort keys are selected, otherwise the projection before
+                          the sort keeps the sort keys too
+    """
+    if isinstance(first, SelectOperation) and isinstance(second, SelectOperation):
+        columns = [column for column in second.kwargs['columns'] if column in first.kwargs['columns']]
+        return [SelectOperation(columns=columns)]
+    if isinstance(first, SortOperation) and isinstance(second, FilterOperation):
+        return [second, first]
+    if isinstance(first, SortOperation) and isinstance(second, SelectOperation):
+        columns = second.kwargs['columns']
+        missing_keys = [key for key in first.kwargs['keys'] if key not in columns]
+        if not missing_keys:
+            return [second, first]
+        if isinstance(previous, SelectOperation) and set(previous.kwargs['columns']) <= set(columns + missing_keys):
+            return None
+        return [SelectOperation(columns=columns + missing_keys), first, second]
+    return None
+
+
+def _counted(_table, entry):
+    """
+    Counts rows, passed through, into *entry['actual_rows']*
+    """
+    entry['actual_rows'] = 0
+    for row in _table:
+        entry['actual_rows'] += 1
+        yield row
+
+
+def _explain(chain, names, profile=None):
+    """
+    Returns the plan of the graph: chains in the execution order with their operations, strategies chosen
+    by the cost model, estimated and actual numbers of rows
+    """
+    chains, _ = chain._graph()
+    lines = []
+    for current in chains:
+        source = current._source
+        lines.append('{} <- {}'.format(names[id(current)], names[id(source)] if isinstance(source, Chain) else source))
+        for operation in current._operations:
+            entry = (profile or {}).get(id(operation), {})
+            details = [
+                '{}: {}'.format(title, entry[field])
+                for field, title in (
+                    ('strategy', 'strategy'), ('estimated_rows', 'estimated rows'), ('actual_rows', 'actual rows')
+                )
+                if entry.get(field) is not None
+            ]
+            description = operation.describe(names)
+            if details:
+                description += ' ({})'.format(', '.join(details))
+            lines.append('    ' + description)
+    return '\n'.join(lines)
+
+
+def _configure_logging(verbose, debug):
+    if debug:
+        logging.basicConfig(
+            format='%(asctime)s - %(levelname)s - %(message)s',
+            level=logging.DEBUG
+        )
+    elif verbose:
+        logging.basicConfig(
+            format='%(asctime)s - %(levelname)s - %(message)s',
+            level=logging.INFO
+        )
+    else:
+        logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def _read_table(input_stream):
+    if _is_materialized(input_stream):
+        return input_stream
+    elif hasattr(input_stream, 'read'):
+        return map(json.loads, input_stream)
+    return iter(input_stream)
+
+
+def _function_name(function):
+    """
+    Returns the importable name of *function* in 'module:qualname' form
+    """
+    module = getattr(function, '__module__', None)
+    qualname = getattr(function, '__qualname__', '')
+    if not module or not qualname or '<' in qualname:
+        raise ValueError(
+            'Function {!r} can not be referenced by an importable name, define it at module level'.format(function)
+        )
+    return '{}:{}'.format(module, qualname)
+
+
+def _import_function(name):
+    """
+    Imports the function by the name, created by *_function_name*
+    """
+    module_name, _, qualname = name.partition(':')
+    function = importlib.import_module(module_name)
+    for attribute in qualname.split('.'):
+        function = getattr(function, attribute)
+    return function
 
 
 class Operation(ABC):
+    name = None
+    functions = ()
+    streaming = False
+
     def __init__(self, **kwargs):
         self.kwargs = kwargs
         super().__init__()
 
     @abstractmethod
-    def run(self, _table, verbose=False, **kwargs):
+    def run(self, _table, context=None):
         pass
 
+    def describe(self, names: dict) -> str:
+        """
+        Returns a short description of the operation for *explain*
+
+        :param names: dict, which maps ids of chains to their names
+        """
+        return self.name
+
+    def estimate(self, stats, context):
+        """
+        Returns estimated statistics of the output table by statistics of the input one
+        """
+        return stats
+
+    def ordering(self, input_ordering):
+        """
+        Returns keys, the output table is sorted by, if the input table is sorted by *input_ordering*
+        """
+        return None
+
+    def chains(self) -> list:
+        """
+        Returns other chains, the operation reads
+        """
+        return []
+
+    def source_names(self) -> list:
+        """
+        Returns names of sources, the operation reads
+        """
+        return []
+
+    def _input_sorted_by(self, context, keys, grouping=False):
+        """
+        Returns True if the input table is known to be sorted by *keys* in this order.
+        If *grouping* is True, any order of *keys* is enough
+        """
+        if context is None:
+            return False
+        return _ordered_by(context.orderings.get(id(self)), keys, grouping)
+
+    def _input_stats(self, _table, context):
+        if context is None or not context.collect_stats:
+            return None
+        if _is_materialized(_table):
+            return TableStats.from_table(_table)
+        if id(self) in context.profile:
+            return context.profile[id(self)]['input_stats']
+        return None
+
+    def _set_strategy(self, context, strategy):
+        if context is not None and id(self) in context.profile:
+            context.profile[id(self)]['strategy'] = strategy
+        logging.debug('Operation %s uses %s strategy', self.name, strategy)
+
+    def to_plan(self):
+        """
+        Serializes the operation into a dict, functions are replaced with their importable names
+        """
+        plan = {'operation': self.name}
+        for key, value in self.kwargs.items():
+            plan[key] = _function_name(value) if key in self.functions and value is not None else value
+        return plan
+
+    @staticmethod
+    def from_plan(plan):
+        """
+        Builds the operation from the dict, created by *to_plan*
+        """
+        plan = dict(plan)
+        operation_class = OPERATIONS[plan.pop('operation')]
+        for key in operation_class.functions:
+            if plan.get(key) is not None:
+                plan[key] = _import_function(plan[key])
+        return operation_class(**plan)
+
 
 class MapOperation(Operation):
-    def run(self, _table, verbose=False, **kwargs):
+    name = 'map'
+    functions = ('mapper_function',)
+    streaming = True
+
+    def describe(self, names):
+        return 'map {}'.format(self.kwargs['mapper_function'].__name__)
+
+    def run(self, _table, context=None):
         mapper_function = self.kwargs['mapper_function']
         for row in _table:
             yield from mapper_function(row)
 
 
+class FilterOperation(Operation):
+    name = 'filter'
+    functions = ('predicate',)
+    streaming = True
+
+    def describe(self, names):
+        return 'filter {}'.format(self.kwargs['predicate'].__name__)
+
+    def ordering(self, input_ordering):
+        return input_ordering
+
+    def run(self, _table, context=None):
+        return filter(self.kwargs['predicate'], _table)
+
+
+class SelectOperation(Operation):
+    name = 'select'
+    streaming = True
+
+    def describe(self, names):
+        return 'select {}'.format(self.kwargs['columns'])
+
+    def ordering(self, input_ordering):
+        if input_ordering is None:
+            return None
+        ordering = list(itertools.takewhile(lambda key: key in self.kwargs['columns'], input_ordering))
+        return ordering or None
+
+    def run(self, _table, context=None):
+        columns = self.kwargs['columns']
+        for row in _table:
+            yield {column: row[column] for column in columns if column in row}
+
+
 class ReduceOperation(Operation):
-    def run(self, _table, verbose=False, **kwargs):
+    name = 'reduce'
+    functions = ('reducer_function',)
+
+    def describe(self, names):
+        return 'reduce {} by {}'.format(self.kwargs['reducer_function'].__name__, list(self.kwargs['keys']))
+
+    def estimate(self, stats, context):
+        if stats is None:
+            return None
+        return TableStats(stats.distinct_rows(self.kwargs['keys']), row_size=stats.row_size)
+
+    def run(self, _table, context=None):
         reducer_function = self.kwargs['reducer_function']
         keys = self.kwargs['keys']
 
-        group_keys = []
+        def group_key(row):
+            return [row[column] for column in keys]
 
-        for key, group in groupby(_table, key=lambda k: [k[column] for column in keys]):
+        cost_model = context.cost_model if context is not None else CostModel()
+        is_sorted = self._input_sorted_by(context, keys, grouping=True)
+        strategy = cost_model.choose_reduce(self._input_stats(_table, context), is_sorted)
+        self._set_strategy(context, strategy)
+        if strategy == 'hash':
+            groups = {}
+            for row in _table:
+                groups.setdefault(_hashable_key(row, keys), []).append(row)
+            for group in groups.values():
+                yield from reducer_function(iter(group))
+            return
+        if strategy == 'sort':
+            _table = _sort_table(_table, group_key, context, 'reduce by {}'.format(list(keys)))
+
+        group_keys = set()
+
+        for key, group in groupby(_table, key=group_key):
+            key = _hashable(key)
             if key not in group_keys:
-                group_keys.append(key)
+                group_keys.add(key)
             else:
                 logging.error('Table is not sorted, result of this operation is unexpectable.')
             yield from reducer_function(group)
 
 
+class AggregateOperation(Operation):
+    name = 'aggregate'
+    batch_size = 1024
+
+    def __init__(self, keys, aggregations, phase='complete'):
+        """
+        Construct an AggregateOperation object
+
+        :param keys: keys to be used in grouping
+        :param aggregations: dict, which maps result columns to expressions or their plans
+        :param phase: 'complete' yields results of groups, 'partial' yields states of groups
+            in the *STATES_COLUMN* column, 'final' merges such states and yields results
+        """
+        super().__init__(keys=keys, aggregations=aggregations, phase=phase)
+        self._aggregation = Aggregation(aggregations)
+
+    def to_plan(self):
+        plan = super().to_plan()
+        plan['aggregations'] = self._aggregation.to_plan()
+        return plan
+
+    def describe(self, names):
+        expressions = ', '.join(
+            '{}: {!r}'.format(name, expression) for name, expression in self._aggregation.expressions.items()
+        )
+        return 'aggregate {{{}}} by {}'.format(expressions, self.kwargs['keys'])
+
+    def estimate(self, stats, context):
+        if not self.kwargs['keys']:
+            return TableStats(1)
+        if stats is None:
+            return None
+        return TableStats(stats.distinct_rows(self.kwargs['keys']))
+
+    def ordering(self, input_ordering):
+        keys = self.kwargs['keys']
+        if keys and _ordered_by(input_ordering, keys, grouping=True):
+            return list(input_ordering[:len(keys)])
+        return None
+
+    def run(self, _table, context=None):
+        keys = self.kwargs['keys']
+        phase = self.kwargs['phase']
+        aggregation = self._aggregation
+        key_getter = itemgetter(*keys) if keys else lambda row: ()
+        groups = {}
+        if not keys and phase != 'final':
+            groups[()] = aggregation.initial()
+
+        if phase == 'final':
+            for row in _table:
+                key = key_getter(row)
+                states = groups.get(key)
+                groups[key] = row[STATES_COLUMN] if states is None else aggregation.merge(states, row[STATES_COLUMN])
+        else:
+            _table = iter(_table)
+            while True:
+                batch = list(itertools.islice(_table, self.batch_size))
+                if not batch:
+                    break
+                batch_groups = {}
+                for row in batch:
+                    batch_groups.setdefault(key_getter(row), []).append(row)
+                for key, rows in batch_groups.items():
+                    states = groups.get(key)
+                    if states is None:
+                        states = groups[key] = aggregation.initial()
+                    aggregation.update(states, rows)
+
+        for key, states in groups.items():
+            row = dict(zip(keys, key if len(keys) > 1 else (key,)))
+            if phase == 'partial':
+                row[STATES_COLUMN] = states
+            else:
+                row.update(aggregation.results(states))
+            yield row
+
+
+class DistinctOperation(Operation):
+    name = 'distinct'
+
+    def describe(self, names):
+        return 'distinct by {}{}'.format(self.kwargs['keys'], ' approximate' if self.kwargs['approximate'] else '')
+
+    def estimate(self, stats, context):
+        if stats is None:
+            return None
+        return TableStats(stats.distinct_rows(self.kwargs['keys']), row_size=stats.row_size)
+
+    def ordering(self, input_ordering):
+        if self.kwargs['presorted'] or _ordered_by(input_ordering, self.kwargs['keys'], grouping=True):
+            return input_ordering
+        return None
+
+    def run(self, _table, context=None):
+        keys = self.kwargs['keys']
+        key_getter = itemgetter(*keys) if keys else lambda row: ()
+        is_sorted = self.kwargs['presorted'] or self._input_sorted_by(context, keys, grouping=True)
+        governor = context.governor if context is not None else None
+
+        if is_sorted:
+            self._set_strategy(context, 'sorted')
+            previous_key = _END
+            for row in _table:
+                key = key_getter(row)
+                if key != previous_key:
+                    previous_key = key
+                    yield row
+        elif self.kwargs['approximate']:
+            self._set_strategy(context, 'bloom')
+            seen = BloomFilter(self.kwargs['capacity'], self.kwargs['error_rate'])
+            for row in _table:
+                if seen.add(key_getter(row)):
+                    yield row
+        elif governor is not None:
+            self._set_strategy(context, 'hash')
+            seen = SpillSet(governor, 'distinct by {}'.format(keys))
+            for row in _table:
+                if seen.add(key_getter(row), row):
+                    yield row
+            yield from seen
+        else:
+            self._set_strategy(context, 'hash')
+            seen = set()
+            for row in _table:
+                key = key_getter(row)
+                if key not in seen:
+                    seen.add(key)
+                    yield row
+
+
+class Window(typing.NamedTuple):
+    """
+    Event-time windows of *size* seconds, starting every *slide* seconds
+    """
+    size: float
+    slide: float
+
+
+def _seconds(value):
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return value
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def _timestamp(value):
+    """
+    Returns seconds since the naive epoch in the clock of *value*. Datetimes are converted by their wall time,
+    so windows do not depend on the time zone of the process
+    """
+    if isinstance(value, datetime):
+        return (value.replace(tzinfo=None) - EPOCH).total_seconds()
+    return value
+
+
+def _from_timestamp(seconds, sample):
+    """
+    Converts seconds, returned by *_timestamp*, into the type of *sample*
+    """
+    if isinstance(sample, datetime):
+        return (EPOCH + timedelta(seconds=seconds)).replace(tzinfo=sample.tzinfo)
+    return seconds
+
+
+def tumbling_window(size: typing.Union[float, timedelta]) -> Window:
+    """
+    Returns non-overlapping windows of *size* seconds
+    """
+    return Window(_seconds(size), _seconds(size))
+
+
+def sliding_window(size: typing.Union[float, timedelta], slide: typing.Union[float, timedelta]) -> Window:
+    """
+    Returns windows of *size* seconds, starting every *slide* seconds
+    """
+    return Window(_seconds(size), _seconds(slide))
+
+
+class WindowReduceOperation(Operation):
+    name = 'window_reduce'
+    functions = ('reducer_function',)
+    streaming = True
+
+    def describe(self, names):
+        return 'window reduce {} by {}'.format(self.kwargs['reducer_function'].__name__, list(self.kwargs['keys']))
+
+    def run(self, _table, context=None):
+        keys = self.kwargs['keys']
+        time_column = self.kwargs['time_column']
+        size, slide = self.kwargs['window']
+        allowed_lateness = self.kwargs['allowed_lateness']
+
+        windows = {}
+        starts = []
+        watermark = float('-inf')
+        sample = None
+        for row in _table:
+            sample = row[time_column]
+            event_time = _timestamp(sample)
+            key = tuple(row[column] for column in keys)
+            start = event_time - event_time % slide
+            late = True
+            while start > event_time - size:
+                if start + size > watermark:
+                    late = False
+                    if start not in windows:
+                        windows[start] = {}
+                        heapq.heappush(starts, start)
+                    windows[start].setdefault(key, []).append(row)
+                start -= slide
+            if late:
+                logging.debug('Late row dropped: %s', row)
+            watermark = max(watermark, event_time - allowed_lateness)
+            while starts and starts[0] + size <= watermark:
+                start = heapq.heappop(starts)
+                yield from self._emit(start, start + size, windows.pop(start), sample)
+        while starts:
+            start = heapq.heappop(starts)
+            yield from self._emit(start, start + size, windows.pop(start), sample)
+
+    def _emit(self, window_start, window_end, groups, sample):
+        reducer_function = self.kwargs['reducer_function']
+        window_start = _from_timestamp(window_start, sample)
+        window_end = _from_timestamp(window_end, sample)
+        for group in groups.values():
+            for row in reducer_function(iter(group)):
+                yield dict(row, window_start=window_start, window_end=window_end)
+
+
+def _fold(folder_function, _table, initial_state):
+    if initial_state is not None:
+        return reduce(folder_function, _table, deepcopy(initial_state))
+    return reduce(folder_function, _table)
+
+
+def _is_picklable(function):
+    try:
+        pickle.dumps(function)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        return False
+    return True
+
+
 class FoldOperation(Operation):
-    def run(self, _table, verbose=False, **kwargs):
+    name = 'fold'
+    functions = ('folder_function', 'merge_function')
+    min_partition_size = 10000
+
+    def describe(self, names):
+        return 'fold {}'.format(self.kwargs['folder_function'].__name__)
+
+    def estimate(self, stats, context):
+        return TableStats(1)
+
+    def run(self, _table, context=None):
         folder_function = self.kwargs['folder_function']
         initial_state = self.kwargs['initial_state']
-        if initial_state:
-            yield reduce(folder_function, _table, initial_state)
+        if self.kwargs.get('merge_function') is None:
+            yield _fold(folder_function, _table, initial_state)
+            return
+
+        _table = list(_table)
+        if not _table:
+            yield _fold(folder_function, _table, initial_state)
+            return
+        workers = self.kwargs.get('workers') or os.cpu_count() or 1
+        partitions_count = max(min(workers, len(_table) // self.min_partition_size), 1)
+        size = -(-len(_table) // partitions_count)
+        partitions = [_table[index:index + size] for index in range(0, len(_table), size)]
+        if len(partitions) > 1 and not _is_picklable(folder_function):
+            logging.warning('Folder function can not be pickled, partitions are folded in one process')
+            states = [_fold(folder_function, partition, initial_state) for partition in partitions]
+        elif len(partitions) > 1:
+            with ProcessPoolExecutor(max_workers=len(partitions)) as executor:
+                states = list(executor.map(
+                    _fold, [folder_function] * len(partitions), partitions, [initial_state] * len(partitions)
+                ))
         else:
-            yield reduce(folder_function, _table)
+            states = [_fold(folder_function, partitions[0], initial_state)]
+        yield self.merge(states)
+
+    def merge(self, states):
+        """
+        Merges partial states pairwise, level by level, using *merge_function*
+        """
+        merge_function = self.kwargs['merge_function']
+        while len(states) > 1:
+            merged = [merge_function(states[index], states[index + 1]) for index in range(0, len(states) - 1, 2)]
+            if len(states) % 2:
+                merged.append(states[-1])
+            states = merged
+        return states[0]
 
 
 class SortOperation(Operation):
-    def run(self, _table, verbose=False, **kwargs):
-        keys = self.kwargs['keys']
+    name = 'sort'
+
+    def describe(self, names):
+        return 'sort by {}{}'.format(list(self.kwargs['keys']), ' reversed' if self.kwargs['reverse'] else '')
+
+    def ordering(self, input_ordering):
+        return None if self.kwargs['reverse'] else list(self.kwargs['keys'])
+
+    def run(self, _table, context=None):
+        if not self.kwargs['reverse'] and self._input_sorted_by(context, self.kwargs['keys']):
+            self._set_strategy(context, 'skip')
+            return _table
+        if context is not None and context.governor is not None:
+            strategy = context.cost_model.choose_sort(self._input_stats(_table, context))
+        else:
+            strategy = 'memory'
+        self._set_strategy(context, strategy)
+        if strategy == 'external':
+            return self._run_external(_table, context.governor)
         reverse = self.kwargs['reverse']
         _table = list(_table)
-        new_keys = [key for key in keys if key in _table[0].keys()]
+        if not _table:
+            return _table
+        return sorted(_table, key=itemgetter(*self._existing_keys(_table[0])), reverse=reverse)
+
+    def _run_external(self, _table, governor):
+        keys = self.kwargs['keys']
+        _table = iter(_table)
+        first_row = next(_table, None)
+        if first_row is None:
+            return
+        sorter = ExternalSorter(
+            governor,
+            'sort by {}'.format(list(keys)),
+            key=itemgetter(*self._existing_keys(first_row)),
+            reverse=self.kwargs['reverse']
+        )
+        sorter.add(first_row)
+        for row in _table:
+            sorter.add(row)
+        yield from sorter
+
+    def _existing_keys(self, row):
+        keys = self.kwargs['keys']
+        new_keys = [key for key in keys if key in row.keys()]
         if new_keys != keys:
             logging.warning('Not all keys exist in the table')
             print('Missing keys:', file=sys.stderr)
             pprint([item for item in keys if item not in new_keys])
-        return sorted(_table, key=itemgetter(*new_keys), reverse=reverse)
+        return new_keys
+
+
+def _is_materialized(_table):
+    return isinstance(_table, (list, SpillBuffer))
+
+
+def _ordered_by(ordering, keys, grouping=False):
+    if ordering is None or len(ordering) < len(keys):
+        return False
+    prefix = list(ordering[:len(keys)])
+    return set(prefix) == set(keys) if grouping else prefix == list(keys)
+
+
+def _hashable(value):
+    """
+    Returns a hashable value, equal for equal values: lists, dicts and sets are converted into tagged tuples
+    """
+    if isinstance(value, list):
+        return list, tuple(_hashable(item) for item in value)
+    if isinstance(value, dict):
+        return dict, frozenset((key, _hashable(item)) for key, item in value.items())
+    if isinstance(value, set):
+        return set, frozenset(value)
+    return value
+
+
+def _hashable_key(row, keys):
+    """
+    Returns the hashable key of *row* for hash grouping by *keys*
+    """
+    return tuple(_hashable(row[key]) for key in keys)
+
+
+def _sort_table(_table, key, context, name):
+    if context is None or context.governor is None:
+        return sorted(_table, key=key)
+    sorter = ExternalSorter(context.governor, 'sort for {}'.format(name), key=key)
+    for row in _table:
+        sorter.add(row)
+    return sorter
+
+
+class _Group:
+    """
+    Group of rows with the same keys. The first row is available without consuming the group
+    """
+
+    __slots__ = ('first', 'rows')
+
+    def __init__(self, first, rows):
+        self.first = first
+        self.rows = rows
+
+
+def _groups(_table, keys):
+    for value, group in groupby(_table, key=lambda k: [k[key] for key in keys]):
+        first = next(group)
+        yield value, _Group(first, itertools.chain([first], group))
+
+
+_END = object()
 
 
 class JoinOperation(Operation):
+    name = 'join'
+    hot_key_threshold = 10000
+
     def _merge_dicts(self, left_dict, right_dict, keys):
         left_keys = left_dict.keys()
         right_keys = right_dict.keys()
@@ -255,44 +1430,196 @@ class JoinOperation(Operation):
         yield new_dict
 
     def _merge_groups_with_different_keys(self, smaller_group, greater_group, keys):
-        greater_keys = greater_group[0].keys()
-        for item in smaller_group:
+        greater_keys = greater_group.first.keys()
+        for item in smaller_group.rows:
             yield from self._merge_dicts(
                 item,
                 {key: None for key in greater_keys - keys},
                 keys
             )
 
-    def run(self, _table, verbose=False, **kwargs):
+    def _merge_groups(self, left_group, right_group, keys, governor):
+        """
+        Yields the cartesian product of two groups. Rows are read from both groups in turns until one
+        of them ends. If the other group is not longer than *hot_key_threshold*, it is read to the end
+        and the product is built left row by left row. Otherwise the key is hot: only the shorter group
+        is kept in memory (and spilled to disk under the memory limit), the longer one is streamed.
+        Groups are buffered in lists, only groups longer than *hot_key_threshold* are moved to spill buffers
+        """
+        def append(rows, row):
+            rows.append(row)
+            if governor is not None and isinstance(rows, list) and len(rows) > self.hot_key_threshold:
+                return SpillBuffer(governor, 'join group by {}'.format(list(self.kwargs['keys'])), rows)
+            return rows
+
+        left_rows, right_rows = [], []
+        left_iterator, right_iterator = iter(left_group.rows), iter(right_group.rows)
+        while True:
+            row = next(left_iterator, _END)
+            if row is _END:
+                larger_is_left, smaller_rows, larger_rows, larger_iterator = (
+                    False, left_rows, right_rows, right_iterator
+                )
+                break
+            left_rows = append(left_rows, row)
+            row = next(right_iterator, _END)
+            if row is _END:
+                larger_is_left, smaller_rows, larger_rows, larger_iterator = (
+                    True, right_rows, left_rows, left_iterator
+                )
+                break
+            right_rows = append(right_rows, row)
+
+        while len(larger_rows) <= self.hot_key_threshold:
+            row = next(larger_iterator, _END)
+            if row is _END:
+                for left_item in left_rows:
+                    for right_item in right_rows:
+                        yield from self._merge_dicts(left_item, right_item, keys)
+                return
+            larger_rows.append(row)
+
+        logging.info(
+            'Hot key %s: streaming more than %d rows against %d rows',
+            [left_group.first[key] for key in keys], len(larger_rows), len(smaller_rows)
+        )
+        for larger_item in itertools.chain(larger_rows, larger_iterator):
+            for smaller_item in smaller_rows:
+                if larger_is_left:
+                    yield from self._merge_dicts(larger_item, smaller_item, keys)
+                else:
+                    yield from self._merge_dicts(smaller_item, larger_item, keys)
+
+    def chains(self):
         on = self.kwargs['on']
-        keys = set(self.kwargs['keys'])
-        strategy = self.kwargs['strategy']
+        return [on] if isinstance(on, Chain) else []
 
+    def describe(self, names):
+        on = self.kwargs['on']
+        return 'join {} by {} with {}'.format(
+            self.kwargs['strategy'],
+            list(self.kwargs['keys']),
+            names.get(id(on), 'chain') if isinstance(on, Chain) else 'table'
+        )
+
+    def estimate(self, stats, context):
+        on = self.kwargs['on']
         if isinstance(on, Chain):
-            new_table = on._run(verbose=verbose, **kwargs)
-            if on._launches >= on._max_launches:
-                del on._table
+            on_stats = context.stats.get(id(on))
         else:
-            new_table = on
+            on_stats = TableStats.from_table(on) if _is_materialized(on) else None
+        if stats is None or on_stats is None:
+            return stats
+        keys = self.kwargs['keys']
+        distinct = max(stats.distinct_rows(keys), on_stats.distinct_rows(keys), 1)
+        rows = stats.rows * on_stats.rows // distinct
+        strategy = self.kwargs['strategy']
+        if strategy in ('left', 'outer'):
+            rows = max(rows, stats.rows)
+        if strategy in ('right', 'outer'):
+            rows = max(rows, on_stats.rows)
+        return TableStats(rows, row_size=stats.row_size + on_stats.row_size)
+
+    def run(self, _table, context=None):
+        on = self.kwargs['on']
+        keys = set(self.kwargs['keys'])
+        strategy = self.kwargs['strategy']
+        governor = context.governor if context is not None else None
+
+        new_table = on._run(context) if isinstance(on, Chain) else on
+        build_stats = None
+        if context is not None and context.collect_stats:
+            build_stats = context.stats.get(id(on))
+            if build_stats is None and _is_materialized(new_table):
+                build_stats = TableStats.from_table(new_table)
+
+        key_columns = list(keys)
+
+        def group_key(row):
+            return [row[key] for key in key_columns]
+
+        build_sorted = isinstance(on, Chain) and _ordered_by(on._ordering(), key_columns)
+        probe_sorted = self._input_sorted_by(context, key_columns)
+        cost_model = context.cost_model if context is not None else CostModel()
+        join_strategy = cost_model.choose_join(build_stats, build_sorted, probe_sorted)
+        self._set_strategy(context, join_strategy)
+        if join_strategy == 'hash':
+            yield from self._hash_join(new_table, _table, key_columns, strategy)
+            return
+        if join_strategy == 'sort_merge':
+            name = 'join by {}'.format(list(self.kwargs['keys']))
+            new_table = _sort_table(new_table, group_key, context, name)
+            _table = _sort_table(_table, group_key, context, name)
+
         if strategy == 'left':
             left_table = _table
             right_table = new_table
         else:
             left_table = new_table
             right_table = _table
+        yield from self._merge_join(left_table, right_table, keys, strategy, governor)
+
+    def _hash_join(self, build_table, probe_table, keys, strategy):
+        """
+        Builds a dict of *build_table* (the *on* table) by keys and looks up rows of *probe_table* in it.
+        Unmatched rows of the build table are yielded at the end
+        """
+        build_is_left = strategy != 'left'
+        yield_unmatched_probe = strategy in ('left', 'outer')
+        yield_unmatched_build = strategy in ('right', 'outer')
+        key_set = set(keys)
 
-        left_groups = groupby(left_table, key=lambda k: [k[key] for key in keys])
-        right_groups = groupby(right_table, key=lambda k: [k[key] for key in keys])
+        index = {}
+        build_columns = None
+        for row in build_table:
+            if build_columns is None:
+                build_columns = row.keys()
+            index.setdefault(_hashable_key(row, keys), []).append(row)
+        build_nones = {key: None for key in (build_columns or set()) - key_set}
 
-        try:
-            left_value, left_group = next(left_groups)
-            right_value, right_group = next(right_groups)
-            previous_left_value = left_value
-            previous_right_value = right_value
-            left_group = list(left_group)
-            right_group = list(right_group)
-        except StopIteration:
-            pass
+        matched = set()
+        probe_columns = None
+        for row in probe_table:
+            if probe_columns is None:
+                probe_columns = row.keys()
+            key = _hashable_key(row, keys)
+            matches = index.get(key)
+            if matches is None:
+                if yield_unmatched_probe:
+                    yield from self._merge_dicts(row, build_nones, key_set)
+                continue
+            matched.add(key)
+            for build_row in matches:
+                if build_is_left:
+                    yield from self._merge_dicts(build_row, row, key_set)
+                else:
+                    yield from self._merge_dicts(row, build_row, key_set)
+
+        if yield_unmatched_build:
+            probe_nones = {key: None for key in (probe_columns or set()) - key_set}
+            for key, rows in index.items():
+                if key not in matched:
+                    for row in rows:
+                        yield from self._merge_dicts(row, probe_nones, key_set)
+
+    def _merge_join(self, left_table, right_table, keys, strategy, governor):
+        left_groups = _groups(left_table, keys)
+        right_groups = _groups(right_table, keys)
+
+        left_value, left_group = next(left_groups, (None, None))
+        right_value, right_group = next(right_groups, (None, None))
+        if left_group is None or right_group is None:
+            if left_group is not None and strategy in ('left', 'right', 'outer'):
+                yield from left_group.rows
+                for _, left_group in left_groups:
+                    yield from left_group.rows
+            if right_group is not None and strategy == 'outer':
+                yield from right_group.rows
+                for _, right_group in right_groups:
+                    yield from right_group.rows
+            return
+        previous_left_value = left_value
+        previous_right_value = right_value
 
         left_groups_empty = False
         right_groups_empty = False
@@ -306,7 +1633,6 @@ class JoinOperation(Operation):
                 try:
                     previous_left_value = left_value
                     left_value, left_group = next(left_groups)
-                    left_group = list(left_group)
                 except StopIteration:
                     left_groups_empty = True
             elif (left_value > right_value or left_groups_empty) and not right_groups_empty:
@@ -315,22 +1641,75 @@ class JoinOperation(Operation):
                 try:
                     previous_right_value = right_value
                     right_value, right_group = next(right_groups)
-                    right_group = list(right_group)
                 except StopIteration:
                     right_groups_empty = True
             else:
-                for left_item in left_group:
-                    for right_item in right_group:
-                        yield from self._merge_dicts(left_item, right_item, keys)
+                yield from self._merge_groups(left_group, right_group, keys, governor)
                 try:
                     previous_left_value = left_value
                     left_value, left_group = next(left_groups)
-                    left_group = list(left_group)
                 except StopIteration:
                     left_groups_empty = True
                 try:
                     previous_right_value = right_value
                     right_value, right_group = next(right_groups)
-                    right_group = list(right_group)
                 except StopIteration:
                     right_groups_empty = True
+
+
+class UnionOperation(Operation):
+    name = 'union'
+
+    def chains(self):
+        return [source for source in self.kwargs['sources'] if isinstance(source, Chain)]
+
+    def source_names(self):
+        return [source for source in self.kwargs['sources'] if not isinstance(source, Chain)]
+
+    def ordering(self, input_ordering):
+        return self.kwargs['sorted_by']
+
+    def describe(self, names):
+        sources = [
+            names.get(id(source), 'chain') if isinstance(source, Chain) else source
+            for source in self.kwargs['sources']
+        ]
+        sorted_by = self.kwargs['sorted_by']
+        return 'union with {}{}'.format(sources, ' sorted by {}'.format(sorted_by) if sorted_by is not None else '')
+
+    def estimate(self, stats, context):
+        for source in self.kwargs['sources']:
+            if isinstance(source, Chain):
+                source_stats = context.stats.get(id(source))
+            else:
+                table = context.inputs[source]
+                source_stats = TableStats.from_table(table) if _is_materialized(table) else None
+            if stats is None or source_stats is None:
+                return None
+            stats = TableStats(
+                stats.rows + source_stats.rows, row_size=max(stats.row_size, source_stats.row_size)
+            )
+        return stats
+
+    def run(self, _table, context=None):
+        tables = [_table]
+        for source in self.kwargs['sources']:
+            if isinstance(source, Chain):
+                tables.append(source._run(context))
+            else:
+                tables.append(_read_table(context.inputs[source]))
+        sorted_by = self.kwargs['sorted_by']
+        if sorted_by is None:
+            self._set_strategy(context, 'concatenate')
+            return itertools.chain.from_iterable(tables)
+        self._set_strategy(context, 'merge')
+        return heapq.merge(*tables, key=lambda row: [row[key] for key in sorted_by])
+
+
+OPERATIONS = {
+    operation_class.name: operation_class
+    for operation_class in (
+        MapOperation, ReduceOperation, FoldOperation, SortOperation, JoinOperation, WindowReduceOperation,
+        UnionOperation, FilterOperation, SelectOperation, AggregateOperation, DistinctOperation
+    )
+}
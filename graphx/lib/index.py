@@ -0,0 +1,240 @@
+"""
+Key-partitioned on-disk tables with a lookup index.
+
+*write_index* splits rows into segments by the hash of the key column. Every segment is a data file
+with JSON rows, sorted by key, and an index file with a sorted array of keys and offsets of their rows:
+
+    header   -- magic and the number of keys
+    entries  -- for every key: offset and length of the encoded key, offset and length of its rows
+    keys     -- encoded keys
+
+Rows are collected into per-segment external sorters, which spill sorted runs to temporary files when
+*memory_limit* is exceeded, so the table need not fit into memory. Every build is written into a new
+generation directory, the *CURRENT* file, which names the live generation, is replaced atomically. *IndexReader* maps the files of the live generation into memory
+and finds keys with a binary search, decoding only the rows of the found key, so there is no load phase.
+
+Example:
+    write_index(chain.run(docs=docs), 'index', key='word')
+    with IndexReader('index') as index:
+        rows = index.lookup('hello')
+"""
+
+import os
+import json
+import mmap
+import shutil
+import struct
+import typing
+
+from graphx.lib.memory import MemoryGovernor, ExternalSorter
+from graphx.lib.partitioning import partition_index
+
+
+MAGIC = b'GXINDEX1'
+HEADER = struct.Struct('<8sQ')
+ENTRY = struct.Struct('<QIQQ')
+CURRENT = 'CURRENT'
+GENERATION_PREFIX = 'generation-'
+
+
+def _encode_key(value) -> bytes:
+    return json.dumps(value, sort_keys=True).encode()
+
+
+def _generations(directory):
+    generations = []
+    for name in os.listdir(directory):
+        if name.startswith(GENERATION_PREFIX) and name[len(GENERATION_PREFIX):].isdigit():
+            generations.append(name)
+    return sorted(generations, key=lambda name: int(name[len(GENERATION_PREFIX):]))
+
+
+def _write_segment(path, rows, key):
+    """
+    Writes rows of one segment, which come sorted by the encoded key. Only the index entries of distinct keys
+    are kept in memory
+    """
+    entries = []
+    with open(path + '.data', 'wb') as data_file:
+        offset = 0
+        for row in rows:
+            encoded_key = _encode_key(row[key])
+            line = json.dumps(row).encode() + b'\n'
+            data_file.write(line)
+            if entries and entries[-1][0] == encoded_key:
+                entries[-1][2] += len(line)
+            else:
+                entries.append([encoded_key, offset, len(line)])
+            offset += len(line)
+        data_file.flush()
+        os.fsync(data_file.fileno())
+
+    with open(path + '.index', 'wb') as index_file:
+        index_file.write(HEADER.pack(MAGIC, len(entries)))
+        key_offset = HEADER.size + ENTRY.size * len(entries)
+        for encoded_key, data_offset, data_length in entries:
+            index_file.write(ENTRY.pack(key_offset, len(encoded_key), data_offset, data_length))
+            key_offset += len(encoded_key)
+        for encoded_key, _, _ in entries:
+            index_file.write(encoded_key)
+        index_file.flush()
+        os.fsync(index_file.fileno())
+
+
+def write_index(
+        table: typing.Iterable[dict],
+        directory: str,
+        key: str,
+        partitions: int = 4,
+        memory_limit: int = 64 * 1024 ** 2
+) -> str:
+    """
+    Writes the table into a new generation of the index in *directory* and makes it live.
+    Readers, which have opened the previous generation, keep using it. Older generations are removed
+
+    :param table: iterable of rows, every row must have the *key* column. It is consumed once, so it can be
+        a generator, e.g. the result of *Chain.stream* or rows read from a file
+    :param directory: directory of the index, created if missing
+    :param key: column to look rows up by
+    :param partitions: number of segments
+    :param memory_limit (optional): approximate memory budget in bytes for collecting rows. If exceeded,
+        sorted runs of segments are spilled to temporary files and merged while the segments are written
+    :return: path of the new generation
+    """
+    os.makedirs(directory, exist_ok=True)
+    generations = _generations(directory)
+    number = int(generations[-1][len(GENERATION_PREFIX):]) + 1 if generations else 1
+    name = '{}{:06d}'.format(GENERATION_PREFIX, number)
+    path = os.path.join(directory, name)
+    os.makedirs(path)
+
+    governor = MemoryGovernor(memory_limit)
+    segments = [
+        ExternalSorter(governor, 'segment {}'.format(index), key=lambda row: _encode_key(row[key]))
+        for index in range(partitions)
+    ]
+    for row in table:
+        segments[partition_index(row, [key], partitions)].add(row)
+    for index, rows in enumerate(segments):
+        _write_segment(os.path.join(path, 'segment-{}'.format(index)), rows, key)
+    with open(os.path.join(path, 'meta.json'), 'w') as meta_file:
+        json.dump({'key': key, 'partitions': partitions}, meta_file)
+
+    current_path = os.path.join(directory, CURRENT)
+    with open(current_path + '.tmp', 'w') as current_file:
+        current_file.write(name)
+        current_file.flush()
+        os.fsync(current_file.fileno())
+    os.replace(current_path + '.tmp', current_path)
+
+    for old_name in generations[:-1]:
+        shutil.rmtree(os.path.join(directory, old_name), ignore_errors=True)
+    return path
+
+
+class _Segment:
+    """
+    Memory-mapped data and index files of one segment
+    """
+
+    def __init__(self, path):
+        self._files = []
+        self.data = self._map(path + '.data')
+        self.index = self._map(path + '.index')
+        magic, self.count = HEADER.unpack_from(self.index, 0)
+        if magic != MAGIC:
+            raise ValueError('{}.index is not an index file'.format(path))
+
+    def _map(self, path):
+        file = open(path, 'rb')
+        self._files.append(file)
+        if os.fstat(file.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        for mapping in (self.data, self.index):
+            if isinstance(mapping, mmap.mmap):
+                mapping.close()
+        for file in self._files:
+            file.close()
+
+    def _entry(self, position):
+        return ENTRY.unpack_from(self.index, HEADER.size + ENTRY.size * position)
+
+    def find(self, encoded_key: bytes):
+        """
+        Returns encoded rows of the key or None. Only the pages of the found rows are read
+        """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            key_offset, key_length, data_offset, data_length = self._entry(middle)
+            middle_key = self.index[key_offset:key_offset + key_length]
+            if middle_key < encoded_key:
+                low = middle + 1
+            elif middle_key > encoded_key:
+                high = middle
+            else:
+                return self.data[data_offset:data_offset + data_length]
+        return None
+
+
+class IndexReader:
+    """
+    Reads the live generation of the index, written by *write_index*
+    """
+
+    def __init__(self, directory: str):
+        """
+        Construct an IndexReader object
+
+        :param directory: directory of the index
+        """
+        self.directory = directory
+        self.generation = None
+        self._segments = []
+        self.refresh()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def refresh(self) -> bool:
+        """
+        Opens the live generation if it has changed since the last call
+
+        :return: True if another generation has been opened
+        """
+        with open(os.path.join(self.directory, CURRENT)) as current_file:
+            generation = current_file.read().strip()
+        if generation == self.generation:
+            return False
+        path = os.path.join(self.directory, generation)
+        with open(os.path.join(path, 'meta.json')) as meta_file:
+            meta = json.load(meta_file)
+        segments = [
+            _Segment(os.path.join(path, 'segment-{}'.format(index))) for index in range(meta['partitions'])
+        ]
+        self.close()
+        self.generation = generation
+        self.key = meta['key']
+        self._segments = segments
+        return True
+
+    def close(self):
+        for segment in self._segments:
+            segment.close()
+        self._segments = []
+
+    def lookup(self, value) -> typing.List[dict]:
+        """
+        Returns rows with *value* in the key column in the order they were written
+        """
+        segment = self._segments[partition_index({self.key: value}, [self.key], len(self._segments))]
+        rows = segment.find(_encode_key(value))
+        if rows is None:
+            return []
+        return [json.loads(line) for line in rows.splitlines()]
@@ -0,0 +1,352 @@
+"""
+Memory budget of a run.
+
+Operations, which keep rows in memory, report the approximate size of their rows to the MemoryGovernor.
+When the total size exceeds the limit, the governor asks the largest consumers to spill their rows
+to temporary files.
+"""
+
+import os
+import sys
+import heapq
+import pickle
+import typing
+import logging
+import tempfile
+import threading
+import weakref
+
+
+def estimate_size(row: dict) -> int:
+    """
+    Returns the approximate number of bytes, occupied by the row, its keys and values
+    """
+    size = sys.getsizeof(row)
+    for key, value in row.items():
+        size += sys.getsizeof(key) + sys.getsizeof(value)
+        if isinstance(value, (list, tuple, set, frozenset)):
+            size += sum(sys.getsizeof(item) for item in value)
+    return size
+
+
+class SizeSampler:
+    """
+    Estimates the average size of rows, measuring every *interval*-th row
+    """
+
+    interval = 64
+
+    def __init__(self):
+        self.count = 0
+        self._sampled_count = 0
+        self._sampled_size = 0
+
+    def add(self, row):
+        if self.count % self.interval == 0:
+            self._sampled_count += 1
+            self._sampled_size += estimate_size(row)
+        self.count += 1
+
+    @property
+    def row_size(self) -> float:
+        return self._sampled_size / self._sampled_count if self._sampled_count else 0
+
+
+class MemoryGovernor:
+    """
+    Tracks memory, held by consumers, and makes the largest of them spill when the limit is exceeded.
+    A consumer has a *name* and a *spill()* method, which moves its rows to disk and returns the number
+    of freed bytes
+    """
+
+    def __init__(self, limit: int, directory: str = None):
+        """
+        Construct a MemoryGovernor object
+
+        :param limit: memory budget in bytes
+        :param directory (optional): directory for spill files, defaults to the system temporary directory
+        """
+        self.limit = limit
+        self.directory = directory
+        self._sizes = weakref.WeakKeyDictionary()
+        self._report = {}
+        self._peak = 0
+        self._lock = threading.RLock()
+
+    def register(self, consumer):
+        with self._lock:
+            self._sizes[consumer] = 0
+            self._report.setdefault(consumer.name, {'peak_bytes': 0, 'spilled_bytes': 0, 'spills': 0})
+
+    def release(self, consumer):
+        with self._lock:
+            self._sizes.pop(consumer, None)
+
+    def update(self, consumer, size: int):
+        """
+        Sets the number of bytes, held by *consumer*, and spills the largest consumers if the budget is exceeded
+        """
+        with self._lock:
+            self._sizes[consumer] = size
+            entry = self._report[consumer.name]
+            entry['peak_bytes'] = max(entry['peak_bytes'], size)
+            total = sum(self._sizes.values())
+            self._peak = max(self._peak, total)
+            if total <= self.limit:
+                return
+            for largest in sorted(self._sizes.keys(), key=self._sizes.get, reverse=True):
+                if total <= self.limit or not self._sizes[largest]:
+                    break
+                freed = largest.spill()
+                logging.info('%s spilled %d bytes to disk', largest.name, freed)
+                self._sizes[largest] = max(self._sizes[largest] - freed, 0)
+                total -= freed
+                entry = self._report[largest.name]
+                entry['spilled_bytes'] += freed
+                entry['spills'] += 1
+
+    def report(self) -> dict:
+        """
+        Returns peak and spilled bytes of every consumer and the peak of the total
+        """
+        with self._lock:
+            report = {name: dict(entry) for name, entry in self._report.items()}
+            return {'limit_bytes': self.limit, 'peak_bytes': self._peak, 'consumers': report}
+
+
+class SpillFile:
+    """
+    Temporary file with pickled rows, removed when the object is garbage collected
+    """
+
+    def __init__(self, directory=None):
+        descriptor, self.path = tempfile.mkstemp(prefix='graphx-', suffix='.spill', dir=directory)
+        self._file = os.fdopen(descriptor, 'wb')
+        self.count = 0
+        self._finalizer = weakref.finalize(self, _remove_file, self._file, self.path)
+
+    def write(self, rows: typing.Iterable[dict]):
+        for row in rows:
+            pickle.dump(row, self._file, pickle.HIGHEST_PROTOCOL)
+            self.count += 1
+        self._file.flush()
+
+    def read(self, count: int = None) -> typing.Iterator[dict]:
+        """
+        Yields the first *count* rows of the file, all rows by default
+        """
+        count = self.count if count is None else count
+        with open(self.path, 'rb') as file:
+            for _ in range(count):
+                yield pickle.load(file)
+
+
+def _remove_file(file, path):
+    file.close()
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class SpillBuffer:
+    """
+    Append-only sequence of rows, which moves its rows to a temporary file when the governor asks it.
+    It can be iterated many times, also while being spilled
+    """
+
+    check_interval = 256
+
+    def __init__(self, governor: MemoryGovernor, name: str, rows: typing.Iterable[dict] = ()):
+        """
+        Construct a SpillBuffer object
+
+        :param governor: MemoryGovernor object, which controls the buffer
+        :param name: name of the consumer in the memory report
+        :param rows (optional): initial rows
+        """
+        self.name = name
+        self._governor = governor
+        self._rows = []
+        self._file = None
+        self._sampler = SizeSampler()
+        governor.register(self)
+        for row in rows:
+            self.append(row)
+        governor.update(self, self.size)
+
+    def __len__(self):
+        return len(self._rows) + (self._file.count if self._file else 0)
+
+    def __iter__(self):
+        rows = self._rows
+        if self._file is not None:
+            yield from self._file.read()
+        yield from rows
+
+    @property
+    def size(self) -> int:
+        return int(len(self._rows) * self._sampler.row_size)
+
+    def append(self, row: dict):
+        self._rows.append(row)
+        self._sampler.add(row)
+        if len(self._rows) % self.check_interval == 0:
+            self._governor.update(self, self.size)
+
+    def spill(self) -> int:
+        size = self.size
+        rows, self._rows = self._rows, []
+        if self._file is None:
+            self._file = SpillFile(self._governor.directory)
+        self._file.write(rows)
+        return size
+
+
+class ExternalSorter:
+    """
+    Collects rows and yields them sorted. When the governor asks, collected rows are sorted
+    and spilled to disk as a run, runs are merged at the end
+    """
+
+    check_interval = 256
+
+    def __init__(self, governor: MemoryGovernor, name: str, key: typing.Callable, reverse: bool = False):
+        """
+        Construct an ExternalSorter object
+
+        :param governor: MemoryGovernor object, which controls the sorter
+        :param name: name of the consumer in the memory report
+        :param key: function, takes a row, returns the value to sort by
+        :param reverse: if True, sort is done in reversed order
+        """
+        self.name = name
+        self._governor = governor
+        self._key = key
+        self._reverse = reverse
+        self._rows = []
+        self._runs = []
+        self._sampler = SizeSampler()
+        governor.register(self)
+
+    @property
+    def size(self) -> int:
+        return int(len(self._rows) * self._sampler.row_size)
+
+    def add(self, row: dict):
+        self._rows.append(row)
+        self._sampler.add(row)
+        if len(self._rows) % self.check_interval == 0:
+            self._governor.update(self, self.size)
+
+    def spill(self) -> int:
+        size = self.size
+        rows, self._rows = self._rows, []
+        run = SpillFile(self._governor.directory)
+        run.write(sorted(rows, key=self._key, reverse=self._reverse))
+        self._runs.append(run)
+        return size
+
+    def __iter__(self):
+        rows = sorted(self._rows, key=self._key, reverse=self._reverse)
+        self._rows = []
+        runs = [run.read() for run in self._runs] + [rows]
+        try:
+            yield from heapq.merge(*runs, key=self._key, reverse=self._reverse)
+        finally:
+            self._governor.release(self)
+
+
+class SpillSet:
+    """
+    Set of keys, which finds the first row of every key. When the governor asks, the known keys are moved
+    to partition files on disk, and all following rows are written to partition files too.
+    Rows on disk are deduplicated partition by partition, when the set is iterated
+    """
+
+    check_interval = 256
+    partitions = 16
+
+    def __init__(self, governor: MemoryGovernor, name: str):
+        """
+        Construct a SpillSet object
+
+        :param governor: MemoryGovernor object, which controls the set
+        :param name: name of the consumer in the memory report
+        """
+        self.name = name
+        self._governor = governor
+        self._keys = set()
+        self._key_size = 0
+        self._key_files = None
+        self._row_files = None
+        self._pending = None
+        governor.register(self)
+
+    @property
+    def size(self) -> int:
+        return len(self._keys) * self._key_size
+
+    def add(self, key: typing.Hashable, row: dict) -> bool:
+        """
+        Returns True if *row* is the first row of *key*, False if it is a duplicate or has been moved to disk
+        """
+        if self._row_files is not None:
+            pending = self._pending[hash(key) % self.partitions]
+            pending.append((key, row))
+            if len(pending) >= self.check_interval:
+                self._flush()
+            return False
+        if key in self._keys:
+            return False
+        self._keys.add(key)
+        if not self._key_size:
+            self._key_size = _key_size(key)
+        if len(self._keys) % self.check_interval == 0:
+            self._governor.update(self, self.size)
+        return True
+
+    def spill(self) -> int:
+        size = self.size
+        if self._key_files is None:
+            self._key_files = [SpillFile(self._governor.directory) for _ in range(self.partitions)]
+            self._row_files = [SpillFile(self._governor.directory) for _ in range(self.partitions)]
+            self._pending = [[] for _ in range(self.partitions)]
+        partitioned_keys = [[] for _ in range(self.partitions)]
+        for key in self._keys:
+            partitioned_keys[hash(key) % self.partitions].append(key)
+        for key_file, keys in zip(self._key_files, partitioned_keys):
+            key_file.write(keys)
+        self._keys = set()
+        return size
+
+    def _flush(self):
+        for row_file, pending in zip(self._row_files, self._pending):
+            if pending:
+                row_file.write(pending)
+                pending.clear()
+
+    def __iter__(self):
+        """
+        Yields first rows of keys, moved to disk
+        """
+        try:
+            if self._row_files is None:
+                return
+            self._flush()
+            for key_file, row_file in zip(self._key_files, self._row_files):
+                keys = set(key_file.read())
+                for key, row in row_file.read():
+                    if key not in keys:
+                        keys.add(key)
+                        yield row
+        finally:
+            self._governor.release(self)
+
+
+def _key_size(key) -> int:
+    # 64 bytes approximate the slot of the key in the set
+    size = sys.getsizeof(key) + 64
+    if isinstance(key, tuple):
+        size += sum(sys.getsizeof(item) for item in key)
+    return size
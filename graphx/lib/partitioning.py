@@ -0,0 +1,15 @@
+"""
+Stable partitioning of rows by key columns, shared by the cluster, its workers and on-disk indexes.
+The hash does not depend on the process, so rows written or shuffled in one process are found in another.
+"""
+
+import zlib
+import typing
+
+
+def partition_index(row: dict, keys: typing.Union[list, tuple], count: int) -> int:
+    """
+    Returns the index of the partition for *row*. The hash is stable between processes,
+    so all workers send rows with equal values in *keys* columns to the same partition
+    """
+    return zlib.crc32(repr([row[key] for key in keys]).encode()) % count
@@ -0,0 +1,106 @@
+"""
+Pipelined execution of graph operations.
+
+Every stage runs in its own thread and passes batches of rows to the next stage through a bounded
+queue. A stage, that gets ahead of its consumer, blocks on the full queue (backpressure).
+"""
+
+import queue
+import typing
+import threading
+
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class PipelineCancelled(Exception):
+    """
+    Raised in stages of the cancelled pipeline
+    """
+
+
+class Pipeline:
+    """
+    Set of stages, linked by bounded queues of row batches
+    """
+
+    poll_interval = 0.1
+
+    def __init__(self, queue_depth: int = 8, batch_size: int = 1024):
+        """
+        Construct a Pipeline object
+
+        :param queue_depth: maximum number of batches in a queue between two stages
+        :param batch_size: maximum number of rows in a batch
+        """
+        self._queue_depth = queue_depth
+        self._batch_size = batch_size
+        self._cancelled = threading.Event()
+        self._threads = []
+
+    def stage(self, function: typing.Callable, table: typing.Iterable) -> typing.Iterator:
+        """
+        Starts a thread, which iterates over *function(table)*
+
+        :param function: takes an iterable of rows, returns an iterable of rows
+        :param table: input rows of the stage
+        :return: iterator over the rows, produced by the stage
+        """
+        output = queue.Queue(maxsize=self._queue_depth)
+        thread = threading.Thread(target=self._produce, args=(function, table, output), daemon=True)
+        self._threads.append(thread)
+        thread.start()
+        return self._consume(output)
+
+    def cancel(self):
+        """
+        Stops all stages and waits for their threads
+        """
+        self._cancelled.set()
+        for thread in self._threads:
+            thread.join()
+
+    def _produce(self, function, table, output):
+        try:
+            batch = []
+            for row in function(table):
+                batch.append(row)
+                if len(batch) >= self._batch_size:
+                    if not self._put(output, batch):
+                        return
+                    batch = []
+            if batch and not self._put(output, batch):
+                return
+            self._put(output, _DONE)
+        except PipelineCancelled:
+            pass
+        except BaseException as exc:
+            self._put(output, _Failure(exc))
+
+    def _put(self, output, item):
+        while not self._cancelled.is_set():
+            try:
+                output.put(item, timeout=self.poll_interval)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _consume(self, output):
+        while True:
+            try:
+                item = output.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if self._cancelled.is_set():
+                    raise PipelineCancelled()
+                continue
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.exception
+            yield from item
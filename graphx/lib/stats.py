@@ -0,0 +1,122 @@
+"""
+Table statistics and the cost model, which chooses physical algorithms of operations.
+"""
+
+import typing
+import itertools
+from collections import Counter
+
+from graphx.lib.memory import estimate_size
+
+
+class TableStats:
+    """
+    Approximate statistics of a table: number of rows, number of distinct values in every column
+    and average row size in bytes
+    """
+
+    sample_size = 1000
+    size_sample_size = 100
+
+    def __init__(self, rows: int, distinct: dict = None, row_size: float = 0):
+        self.rows = rows
+        self.distinct = distinct or {}
+        self.row_size = row_size
+
+    def __repr__(self):
+        return 'TableStats(rows={}, distinct={}, row_size={:.0f})'.format(self.rows, self.distinct, self.row_size)
+
+    @classmethod
+    def from_table(cls, table: typing.Sized):
+        """
+        Computes statistics from a sample of a materialized table.
+        Distinct counts are extrapolated with the GEE estimator
+        """
+        rows = len(table)
+        if isinstance(table, list):
+            sample = table[::max(rows // cls.sample_size, 1)]
+        else:
+            sample = list(itertools.islice(table, cls.sample_size))
+        if not sample:
+            return cls(rows)
+        distinct = {}
+        for column in sample[0]:
+            try:
+                counts = Counter(row[column] for row in sample)
+            except (KeyError, TypeError):
+                continue
+            distinct[column] = _estimate_distinct(counts, len(sample), rows)
+        size_sample = sample[::max(len(sample) // cls.size_sample_size, 1)]
+        row_size = sum(estimate_size(row) for row in size_sample) / len(size_sample)
+        return cls(rows, distinct, row_size)
+
+    @property
+    def size(self) -> float:
+        return self.rows * self.row_size
+
+    def distinct_rows(self, keys: typing.Iterable[str]) -> int:
+        """
+        Returns the estimated number of distinct values of *keys* columns together
+        """
+        distinct = 1
+        for key in keys:
+            distinct *= self.distinct.get(key, self.rows)
+        return min(distinct, self.rows)
+
+
+def _estimate_distinct(counts, sample_rows, rows):
+    if sample_rows >= rows:
+        return len(counts)
+    singletons = sum(1 for count in counts.values() if count == 1)
+    estimate = (rows / sample_rows) ** 0.5 * singletons + len(counts) - singletons
+    return int(min(max(estimate, len(counts)), rows))
+
+
+class CostModel:
+    """
+    Chooses physical algorithms of sort, reduce and join from table statistics and the memory limit
+    """
+
+    memory_share = 0.5
+
+    def __init__(self, memory_limit: int = None):
+        """
+        Construct a CostModel object
+
+        :param memory_limit (optional): memory budget of the run in bytes
+        """
+        self.memory_limit = memory_limit
+
+    def fits(self, stats: TableStats) -> bool:
+        """
+        Returns True if a table with *stats* can be held in memory
+        """
+        if self.memory_limit is None:
+            return True
+        return stats is not None and stats.size <= self.memory_limit * self.memory_share
+
+    def choose_sort(self, stats: TableStats) -> str:
+        """
+        Returns 'memory' for sorting in memory, 'external' for the sort, which spills sorted runs to disk
+        """
+        return 'memory' if self.fits(stats) else 'external'
+
+    def choose_reduce(self, stats: TableStats, is_sorted: bool) -> str:
+        """
+        Returns 'stream' for grouping neighbouring rows of a sorted table, 'hash' for grouping in a dict,
+        'sort' for sorting the table first. *is_sorted* is True only if the order of the table is known
+        from the graph, the same in every execution mode, so tables of unknown order are grouped by keys
+        """
+        if is_sorted:
+            return 'stream'
+        return 'hash' if self.fits(stats) else 'sort'
+
+    def choose_join(self, build_stats: TableStats, build_sorted: bool, probe_sorted: bool) -> str:
+        """
+        Returns 'merge' for merging sorted tables, 'hash' for building a dict of the joined (build) table
+        and probing it with rows of the chain, 'sort_merge' for sorting both tables and merging them.
+        Tables of unknown order are not trusted to be sorted
+        """
+        if build_sorted and probe_sorted:
+            return 'merge'
+        return 'hash' if self.fits(build_stats) else 'sort_merge'
@@ -0,0 +1,123 @@
+"""
+Worker for the distributed graph execution.
+
+The worker listens on a TCP or Unix socket and executes tasks, sent by the coordinator
+(see graphx.lib.cluster). Start it with:
+
+    python -m graphx.lib.worker --address 127.0.0.1:6000
+    python -m graphx.lib.worker --address /tmp/graphx-worker.sock
+"""
+
+import os
+import sys
+import typing
+import logging
+import argparse
+import threading
+import traceback
+from multiprocessing.connection import Listener
+
+from graphx.lib.graphx import Operation
+from graphx.lib.partitioning import partition_index
+
+
+AUTHKEY_VARIABLE = 'GRAPHX_AUTHKEY'
+
+
+def environment_authkey() -> typing.Optional[bytes]:
+    """
+    Returns the authentication key from $GRAPHX_AUTHKEY or None, if it is not set
+    """
+    authkey = os.environ.get(AUTHKEY_VARIABLE)
+    return authkey.encode() if authkey else None
+
+
+def parse_address(address: typing.Union[str, tuple]):
+    """
+    Converts 'host:port' string into (host, port) tuple, other strings are treated as Unix socket paths
+    """
+    if isinstance(address, str) and ':' in address and not address.startswith(os.sep):
+        host, _, port = address.rpartition(':')
+        return host, int(port)
+    return address
+
+
+def run_task(task: dict):
+    """
+    Executes the task and returns the resulting table
+
+    :param task: dict with fields
+        *operations* -- list of operation plans, see Operation.to_plan. Join operations take the right
+                        table from the *on* field. The order of tables is unknown, so joins build hash tables
+        *table*      -- list of rows
+        *partition*  -- optional dict with *keys* and *count* fields. If provided, the result is split
+                        into *count* lists by the hash of *keys* columns
+    """
+    table = task['table']
+    for operation_plan in task['operations']:
+        operation = Operation.from_plan(operation_plan)
+        table = operation.run(table)
+    partition = task.get('partition')
+    if partition is None:
+        return list(table)
+    buckets = [[] for _ in range(partition['count'])]
+    for row in table:
+        buckets[partition_index(row, partition['keys'], partition['count'])].append(row)
+    return buckets
+
+
+def _handle(connection):
+    with connection:
+        while True:
+            try:
+                task = connection.recv()
+            except EOFError:
+                return
+            try:
+                result = ('ok', run_task(task))
+            except Exception:
+                logging.exception('Task failed')
+                result = ('error', traceback.format_exc())
+            connection.send(result)
+
+
+def serve(address: typing.Union[str, tuple], authkey: bytes):
+    """
+    Listens on *address* and executes incoming tasks until the process is killed.
+    Every coordinator connection is served in a separate thread. Tasks run arbitrary importable
+    functions, so the key must be secret: anyone who knows it can run code on the machine
+
+    :param address: 'host:port' string, (host, port) tuple or Unix socket path
+    :param authkey: key, used to authenticate coordinators
+    """
+    with Listener(parse_address(address), authkey=authkey) as listener:
+        listen_address = listener.address
+        if isinstance(listen_address, tuple):
+            listen_address = '{}:{}'.format(*listen_address)
+        print('graphx worker listening on', listen_address, flush=True)
+        while True:
+            try:
+                connection = listener.accept()
+            except Exception:
+                logging.exception('Connection failed')
+                continue
+            threading.Thread(target=_handle, args=(connection,), daemon=True).start()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='graphx worker')
+    parser.add_argument('--address', default='127.0.0.1:0', help='host:port or Unix socket path')
+    parser.add_argument('--authkey', default=None, help='secret authentication key, defaults to $GRAPHX_AUTHKEY')
+    args = parser.parse_args(argv)
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s')
+    authkey = args.authkey.encode() if args.authkey else environment_authkey()
+    if authkey is None:
+        parser.error('authentication key is required, pass --authkey or set $GRAPHX_AUTHKEY')
+    try:
+        serve(args.address, authkey=authkey)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    sys.exit(main())
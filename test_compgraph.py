@@ -1,6 +1,18 @@
 '''Tests for graph functions'''
 
+import os
+import sys
+import time
+import secrets
+import threading
+import subprocess
+from datetime import datetime, timedelta
+
+import pytest
+
 import graphx.lib.graphx as gx
+from graphx.lib.cluster import Cluster
+from graphx.lib.index import write_index, IndexReader
 
 
 def mapper_double(row):
@@ -290,3 +302,670 @@ def test_join_chain_inner():
     result = chain_table.run(table=table, speed=speed)
 
     assert result == etalon
+
+
+@pytest.fixture
+def workers(monkeypatch):
+    monkeypatch.setenv('GRAPHX_AUTHKEY', secrets.token_hex(16))
+    processes = [
+        subprocess.Popen(
+            [sys.executable, '-m', 'graphx.lib.worker', '--address', '127.0.0.1:0'],
+            stdout=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            universal_newlines=True
+        )
+        for _ in range(3)
+    ]
+    addresses = [process.stdout.readline().split()[-1] for process in processes]
+    yield processes, addresses
+    for process in processes:
+        process.kill()
+        process.wait()
+
+
+def test_worker_requires_authkey(monkeypatch):
+    monkeypatch.delenv('GRAPHX_AUTHKEY', raising=False)
+    process = subprocess.run(
+        [sys.executable, '-m', 'graphx.lib.worker', '--address', '127.0.0.1:0'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        timeout=30
+    )
+
+    assert process.returncode != 0
+    assert 'authentication key is required' in process.stderr
+    with pytest.raises(ValueError):
+        Cluster(['127.0.0.1:6000'])
+
+
+def build_distributed_graph():
+    speed = gx.Chain(source='speed')
+    speed.add_sort(['index'])
+
+    chain = gx.Chain(source='table')
+    chain.add_map(mapper_double)
+    chain.add_sort(['index'])
+    chain.add_reduce(reducer_unique, ['index'])
+    chain.add_join(speed, ['index'], 'outer')
+    chain.add_sort(['index'])
+    return chain
+
+
+def test_plan_roundtrip():
+    chain = build_distributed_graph()
+    plan = chain.to_plan()
+
+    assert gx.Chain.from_plan(plan).to_plan() == plan
+    assert plan['chains'][1]['operations'][0] == {'operation': 'map', 'mapper_function': 'test_compgraph:mapper_double'}
+
+
+def test_cluster_run(workers):
+    processes, addresses = workers
+    table = [{'distance': index % 4, 'time': index * 2, 'index': index} for index in range(20)]
+    speed = [{'index': index, 'speed': index * 10} for index in range(0, 30, 3)]
+
+    etalon = build_distributed_graph().run(table=table, speed=speed)
+
+    with Cluster(addresses) as cluster:
+        assert cluster.run(build_distributed_graph(), table=table, speed=speed) == etalon
+        processes[0].kill()
+        processes[0].wait()
+        assert cluster.run(build_distributed_graph(), table=table, speed=speed) == etalon
+
+
+def predicate_negative_index(row):
+    return row['index'] < 0
+
+
+def test_cluster_empty_sort(workers):
+    _, addresses = workers
+    table = [{'distance': index % 4, 'time': index * 2, 'index': index} for index in range(20)]
+
+    chain = gx.Chain(source='table')
+    chain.add_filter(predicate_negative_index)
+    chain.add_sort(['distance'])
+
+    with Cluster(addresses) as cluster:
+        assert cluster.run(chain, table=table) == []
+        assert cluster.run(chain, table=[]) == []
+
+
+def test_cluster_union(workers):
+    _, addresses = workers
+    shards = {
+        day: [{'index': index, 'day': day} for index in range(offset, 30, 3)]
+        for offset, day in enumerate(['monday', 'tuesday', 'wednesday'])
+    }
+
+    wednesday = gx.Chain(source='wednesday')
+    wednesday.add_sort(['index'])
+
+    chain = gx.Chain(source='monday')
+    chain.add_union('tuesday', wednesday, sorted_by=['index'])
+    chain.add_sort(['index'])
+    chain.add_reduce(reducer_unique, ['index'])
+
+    etalon = chain.run(**shards)
+
+    with Cluster(addresses) as cluster:
+        assert sort_rows(cluster.run(chain, **shards)) == sort_rows(etalon)
+
+
+def test_cluster_aggregate(workers):
+    _, addresses = workers
+    table = [{'distance': index % 4, 'time': index % 6 + 1} for index in range(2000)]
+
+    chain = gx.Chain(source='table')
+    chain.add_aggregate(['distance'], {
+        'count': gx.agg.count(),
+        'speed': gx.agg.sum('distance') / gx.agg.sum('time') * 2,
+        'mean': gx.agg.mean('time'),
+        'min': gx.agg.min('time'),
+        'max': gx.agg.max('time'),
+        'times': gx.agg.distinct('time')
+    })
+    chain.add_sort(['distance'])
+
+    etalon = chain.run(table=table)
+
+    with Cluster(addresses) as cluster:
+        assert cluster.run(chain, table=table) == etalon
+
+
+def test_cluster_distinct(workers):
+    _, addresses = workers
+    table = [{'doc_id': index % 13, 'word': index % 7, 'index': index} for index in range(3000)]
+
+    chain = gx.Chain(source='table')
+    chain.add_distinct(['doc_id', 'word'])
+
+    etalon = chain.run(table=table)
+
+    with Cluster(addresses) as cluster:
+        assert sort_rows(cluster.run(chain, table=table)) == sort_rows(etalon)
+
+
+def merge_sum_columnwise(state, other_state):
+    for column in state:
+        state[column] += other_state[column]
+    return state
+
+
+def test_fold_parallel(monkeypatch):
+    monkeypatch.setattr(gx.FoldOperation, 'min_partition_size', 2)
+    table = [{'distance': index % 3, 'time': index, 'index': index} for index in range(10)]
+
+    etalon = [
+        {'distance': 9, 'time': 45, 'index': 45}
+    ]
+
+    chain = gx.Chain(source='table')
+    chain.add_fold(folder_sum_columnwise, {'distance': 0, 'time': 0, 'index': 0}, merge_sum_columnwise, workers=3)
+
+    assert chain.run(table=table) == etalon
+    assert chain.run(table=table) == etalon
+
+
+def test_fold_falsy_initial_state():
+    table = [{'count': 1}, {'count': 2}]
+
+    chain = gx.Chain(source='table')
+    chain.add_fold(lambda state, record: state + record['count'], 0)
+
+    assert chain.run(table=table) == [3]
+
+
+def mapper_fail_on_third(row):
+    if row['index'] == 3:
+        raise ValueError('Bad row')
+    yield row
+
+
+def test_pipeline():
+    table = [{'distance': index % 4, 'time': index * 2, 'index': index} for index in range(100)]
+
+    chain = gx.Chain(source='table')
+    chain.add_map(mapper_double)
+    chain.add_sort(['distance', 'index'])
+    chain.add_reduce(reducer_unique, ['distance', 'index'])
+    etalon = chain.run(table=table)
+
+    chain.enable_pipeline(queue_depth=2, batch_size=7)
+
+    assert chain.run(table=table) == etalon
+
+
+def test_pipeline_error():
+    table = [{'index': index} for index in range(100)]
+    threads_count = threading.active_count()
+
+    chain = gx.Chain(source='table')
+    chain.add_map(mapper_double)
+    chain.add_map(mapper_fail_on_third)
+    chain.add_map(mapper_double)
+    chain.enable_pipeline(queue_depth=1, batch_size=1)
+
+    with pytest.raises(ValueError):
+        chain.run(table=table)
+    assert threading.active_count() == threads_count
+
+
+def speed_reducer(group):
+    total_distance = 0
+    total_time = 0
+    for row in group:
+        total_distance += row['distance']
+        total_time += row['time']
+    yield {'edge': row['edge'], 'speed': total_distance / total_time}
+
+
+def test_window_reduce_stream():
+    consumed = []
+
+    def traversals():
+        for index in range(1000):
+            consumed.append(index)
+            yield {'edge': index % 2, 'distance': index % 5, 'time': 1, 'enter_time': index}
+        yield {'edge': 0, 'distance': 100, 'time': 1, 'enter_time': 5}
+
+    chain = gx.Chain(source='traversals')
+    chain.add_window_reduce(speed_reducer, ['edge'], 'enter_time', gx.tumbling_window(10), allowed_lateness=2)
+
+    stream = chain.stream(traversals=traversals())
+
+    assert next(stream) == {'edge': 0, 'speed': 2.0, 'window_start': 0, 'window_end': 10}
+    assert next(stream) == {'edge': 1, 'speed': 2.0, 'window_start': 0, 'window_end': 10}
+    assert len(consumed) == 13
+
+    result = list(stream)
+
+    assert len(result) == 198
+    assert result[-1] == {'edge': 1, 'speed': 2.0, 'window_start': 990, 'window_end': 1000}
+
+
+def test_window_reduce_sliding():
+    table = [{'edge': 0, 'distance': index, 'time': 1, 'enter_time': index} for index in range(6)]
+
+    etalon = [
+        {'edge': 0, 'speed': 0.5, 'window_start': -2, 'window_end': 2},
+        {'edge': 0, 'speed': 1.5, 'window_start': 0, 'window_end': 4},
+        {'edge': 0, 'speed': 3.5, 'window_start': 2, 'window_end': 6},
+        {'edge': 0, 'speed': 4.5, 'window_start': 4, 'window_end': 8},
+    ]
+
+    chain = gx.Chain(source='table')
+    chain.add_window_reduce(speed_reducer, ['edge'], 'enter_time', gx.sliding_window(4, 2))
+
+    assert chain.run(table=table) == etalon
+    with pytest.raises(ValueError):
+        chain.add_sort(['edge']).stream(table=table)
+
+
+def test_window_reduce_datetime(monkeypatch):
+    if not hasattr(time, 'tzset'):
+        pytest.skip('time zones can not be changed')
+    monkeypatch.setenv('TZ', 'Asia/Kolkata')
+    time.tzset()
+    try:
+        table = [
+            {'edge': 0, 'distance': 1, 'time': 1, 'enter_time': datetime(2017, 10, 2, 10) + timedelta(minutes=minutes)}
+            for minutes in range(0, 80, 10)
+        ]
+        etalon = [
+            {
+                'edge': 0, 'speed': 1.0,
+                'window_start': datetime(2017, 10, 2, 10), 'window_end': datetime(2017, 10, 2, 11)
+            },
+            {
+                'edge': 0, 'speed': 1.0,
+                'window_start': datetime(2017, 10, 2, 11), 'window_end': datetime(2017, 10, 2, 12)
+            },
+        ]
+
+        chain = gx.Chain(source='table')
+        chain.add_window_reduce(speed_reducer, ['edge'], 'enter_time', gx.tumbling_window(timedelta(hours=1)))
+
+        assert chain.run(table=table) == etalon
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+def test_prepared_run_many():
+    inputs = [
+        {
+            'table': [{'distance': index % 4, 'time': index, 'index': index} for index in range(size)],
+            'speed': [{'index': index, 'speed': index * 10} for index in range(0, size, 3)],
+        }
+        for size in range(1, 30)
+    ]
+
+    chain = build_distributed_graph()
+    etalon = [chain.run(**kwargs) for kwargs in inputs]
+
+    prepared = chain.prepare()
+    chain.add_map(mapper_double)
+
+    assert list(prepared.run_many(inputs, workers=4)) == etalon
+    assert list(prepared.run_many(inputs)) == etalon
+    assert prepared.sources == {'table', 'speed'}
+    with pytest.raises(ValueError):
+        prepared.run(table=[])
+
+
+def test_prepared_run_many_profiles():
+    inputs = [{'table': [{'index': index} for index in range(size, 0, -1)], 'profile': True} for size in range(1, 30)]
+
+    chain = gx.Chain(source='table')
+    chain.add_sort(['index'])
+    prepared = chain.prepare()
+
+    for size, result in enumerate(prepared.run_many(inputs, workers=4), 1):
+        assert result == [{'index': index} for index in range(1, size + 1)]
+        assert 'actual rows: {})'.format(size) in result.explain()
+    assert 'actual rows' not in prepared.explain()
+
+
+def test_run_reuses_prepared_graph():
+    table = [{'index': index, 'distance': index % 4} for index in range(10)]
+    speed = [{'index': index, 'speed': index * 10} for index in range(0, 10, 3)]
+    etalon = [{'index': index, 'distance': index % 4, 'speed': index * 10} for index in range(0, 10, 3)]
+
+    source = gx.Chain(source='table')
+    chain = gx.Chain(source=source)
+    chain.add_join(speed, ['index'])
+
+    assert chain.run(table=table) == etalon
+    prepared = chain._prepared
+    assert chain.run(table=table) == etalon
+    assert chain._prepared is prepared
+    assert prepared._chain._operations[0].kwargs['on'] is speed
+
+    source.add_filter(predicate_even_index)
+    assert chain.run(table=table) == [row for row in etalon if row['index'] % 2 == 0]
+    assert chain._prepared is not prepared
+
+
+def test_memory_limit():
+    table = [{'distance': index % 7, 'time': index % 13, 'index': index} for index in range(3000)]
+    speed = [{'index': index, 'speed': index * 10} for index in range(0, 3000, 2)]
+
+    chain = build_distributed_graph()
+    etalon = chain.run(table=table, speed=speed)
+
+    assert chain.run(table=table, speed=speed, memory_limit=10000) == etalon
+    assert chain.memory_report['limit_bytes'] == 10000
+    assert chain.memory_report['consumers']["sort by ['index']"]['spills'] > 0
+
+
+def test_memory_limit_shared_chain():
+    shared = gx.Chain(source='table')
+    shared.add_map(mapper_double)
+    first = gx.Chain(source=shared)
+    first.add_fold(folder_sum_columnwise, {'distance': 0})
+    chain = gx.Chain(source=shared)
+    chain.add_fold(folder_sum_columnwise, {'time': 0})
+    chain.add_join(first, [], 'inner')
+
+    table = ({'distance': index % 7, 'time': index % 13} for index in range(3000))
+    assert chain.run(table=table, memory_limit=10000) == [{'distance': 17988, 'time': 35970}]
+    report = chain.memory_report['consumers']['table of chain 0']
+    assert report['spills'] > 0
+    assert report['peak_bytes'] < report['spilled_bytes']
+
+
+def build_skewed_tables():
+    table = [{'distance': index, 'time': index % 3, 'index': index % 5 and index} for index in range(200)]
+    speed = [{'index': index % 7 and index, 'speed': index} for index in range(0, 300, 3)]
+    return sorted(table, key=lambda row: row['index']), sorted(speed, key=lambda row: row['index'])
+
+
+def build_skewed_graph(strategy):
+    chain = gx.Chain(source='table')
+    chain.add_join(gx.Chain(source='speed'), ['index'], strategy)
+    return chain
+
+
+def sort_rows(rows):
+    return sorted(rows, key=lambda row: repr(sorted(row.items())))
+
+
+@pytest.mark.parametrize('strategy', ['inner', 'left', 'outer'])
+def test_join_hot_keys(monkeypatch, strategy):
+    table, speed = build_skewed_tables()
+    etalon = build_skewed_graph(strategy).run(table=table, speed=speed)
+
+    monkeypatch.setattr(gx.JoinOperation, 'hot_key_threshold', 5)
+
+    assert sort_rows(build_skewed_graph(strategy).run(table=table, speed=speed)) == sort_rows(etalon)
+    result = build_skewed_graph(strategy).run(table=table, speed=speed, memory_limit=1000)
+    assert sort_rows(result) == sort_rows(etalon)
+
+
+def test_cluster_join_hot_keys(workers):
+    _, addresses = workers
+    table, speed = build_skewed_tables()
+
+    with Cluster(addresses) as cluster:
+        for strategy in ('inner', 'right', 'outer'):
+            etalon = build_skewed_graph(strategy).run(table=table, speed=speed)
+            result = cluster.run(build_skewed_graph(strategy), table=table, speed=speed)
+            assert sort_rows(result) == sort_rows(etalon)
+
+
+@pytest.mark.parametrize('strategy', ['inner', 'left', 'right', 'outer'])
+def test_join_unsorted_tables(strategy):
+    table, speed = build_skewed_tables()
+    etalon = build_skewed_graph(strategy).run(table=table, speed=speed)
+    table, speed = table[::-1], speed[1::2] + speed[::2]
+
+    chain = build_skewed_graph(strategy)
+    assert sort_rows(chain.run(table=table, speed=speed, profile=True)) == sort_rows(etalon)
+    assert 'strategy: hash' in chain.explain()
+    assert sort_rows(chain.run(table=table, speed=speed, memory_limit=1000, profile=True)) == sort_rows(etalon)
+    assert 'strategy: sort_merge' in chain.explain()
+
+
+def test_reduce_unsorted_table():
+    table = [{'doc_id': index % 3, 'text': 'word'} for index in range(10)]
+    etalon = [{'doc_id': 0, 'text': 'word'}, {'doc_id': 1, 'text': 'word'}, {'doc_id': 2, 'text': 'word'}]
+
+    chain = gx.Chain(source='docs')
+    chain.add_reduce(reducer_unique, ['doc_id'])
+    assert sort_rows(chain.run(docs=table, profile=True)) == etalon
+    assert chain.explain() == (
+        'chain 0 <- docs\n'
+        "    reduce reducer_unique by ['doc_id'] (strategy: hash, estimated rows: 3, actual rows: 3)"
+    )
+
+
+def test_reduce_unsorted_table_pipeline():
+    table = [{'doc_id': index % 3, 'text': 'word'} for index in range(10)]
+    etalon = [{'doc_id': 0, 'text': 'word'}, {'doc_id': 1, 'text': 'word'}, {'doc_id': 2, 'text': 'word'}]
+
+    chain = gx.Chain(source='docs')
+    chain.add_map(mapper_double)
+    chain.add_reduce(reducer_unique, ['doc_id'])
+    assert chain.run(docs=table) == etalon
+
+    chain.enable_pipeline(queue_depth=2, batch_size=3)
+    assert chain.run(docs=table) == etalon
+    assert chain.run(docs=iter(table)) == etalon
+
+
+def test_reduce_list_key():
+    table = [{'start': [index % 2, 0], 'index': index} for index in range(6)]
+    etalon = [{'start': [0, 0], 'index': 0}, {'start': [1, 0], 'index': 1}]
+
+    chain = gx.Chain(source='table')
+    chain.add_reduce(reducer_unique, ['start'])
+
+    result = chain.run(table=table)
+
+    assert result == etalon
+
+
+def test_union():
+    shards = {
+        day: [{'index': index, 'day': day} for index in range(offset, 30, 3)]
+        for offset, day in enumerate(['monday', 'tuesday', 'wednesday'])
+    }
+    etalon = sorted([row for rows in shards.values() for row in rows], key=lambda row: row['index'])
+
+    wednesday = gx.Chain(source='wednesday')
+    wednesday.add_sort(['index'])
+
+    chain = gx.Chain(source='monday')
+    chain.add_union('tuesday', wednesday, sorted_by=['index'])
+    chain.add_sort(['index'])
+    chain.add_reduce(reducer_unique, ['index'])
+
+    result = chain.run(profile=True, **shards)
+
+    assert result == etalon
+    assert "sort by ['index'] (strategy: skip" in chain.explain()
+    assert "reduce reducer_unique by ['index'] (strategy: stream" in chain.explain()
+
+
+def test_union_unsorted():
+    shards = {
+        day: [{'index': index, 'day': day} for index in range(offset, 30, 3)]
+        for offset, day in enumerate(['monday', 'tuesday', 'wednesday'])
+    }
+    etalon = sorted([row for rows in shards.values() for row in rows], key=lambda row: row['index'])
+
+    chain = gx.Chain(source='monday')
+    chain.add_union('tuesday', 'wednesday')
+    chain.add_sort(['index'])
+    chain.add_reduce(reducer_unique, ['index'])
+
+    result = chain.run(profile=True, **shards)
+
+    assert result == etalon
+    assert "sort by ['index'] (strategy: memory" in chain.explain()
+
+
+def predicate_even_index(row):
+    return row['index'] % 2 == 0
+
+
+def test_select_filter_pushdown():
+    table = [{'index': index, 'distance': index % 7, 'time': index % 5} for index in range(20, 0, -1)]
+    etalon = [{'distance': index % 7} for index in range(2, 21, 2)]
+
+    chain = gx.Chain(source='table')
+    chain.add_sort(['index'])
+    chain.add_select(['index', 'distance'])
+    chain.add_filter(predicate_even_index)
+    chain.add_select(['distance'])
+    operations = list(chain._operations)
+
+    assert chain.run(table=table) == etalon
+    assert [line.split(' (')[0] for line in chain.explain().splitlines()] == [
+        'chain 0 <- table',
+        "    select ['index', 'distance']",
+        '    filter predicate_even_index',
+        "    sort by ['index']",
+        "    select ['distance']"
+    ]
+    assert chain._operations == operations
+    assert chain.run(table=table) == etalon
+
+
+def test_filter_is_not_moved_before_select():
+    table = [{'index': index, 'distance': index % 7} for index in range(10)]
+
+    chain = gx.Chain(source='table')
+    chain.add_select(['distance'])
+    chain.add_filter(lambda row: 'index' not in row)
+
+    assert chain.run(table=table) == [{'distance': index % 7} for index in range(10)]
+
+
+def test_aggregate(monkeypatch):
+    table = [{'distance': index % 4, 'time': index % 6 + 1} for index in range(2000)]
+    etalon = []
+    for distance in range(4):
+        times = [row['time'] for row in table if row['distance'] == distance]
+        etalon.append({
+            'distance': distance,
+            'count': len(times),
+            'speed': distance * len(times) / sum(times) * 2,
+            'mean': sum(times) / len(times),
+            'min': min(times),
+            'max': max(times),
+            'times': len(set(times))
+        })
+
+    monkeypatch.setattr(gx.AggregateOperation, 'batch_size', 7)
+    chain = gx.Chain(source='table')
+    chain.add_aggregate(['distance'], {
+        'count': gx.agg.count(),
+        'speed': gx.agg.sum('distance') / gx.agg.sum('time') * 2,
+        'mean': gx.agg.mean('time'),
+        'min': gx.agg.min('time'),
+        'max': gx.agg.max('time'),
+        'times': gx.agg.distinct('time')
+    })
+    chain.add_sort(['distance'])
+
+    result = chain.run(table=table)
+
+    assert result == etalon
+
+
+def test_aggregate_empty_table():
+    etalon = [{'count': 0, 'mean': None, 'total': 1}]
+
+    chain = gx.Chain(source='table')
+    chain.add_aggregate([], {'count': gx.agg.count(), 'mean': gx.agg.mean('time'), 'total': 1 + gx.agg.sum('time')})
+
+    result = chain.run(table=[])
+
+    assert result == etalon
+    assert gx.Chain.from_plan(chain.to_plan()).to_plan() == chain.to_plan()
+
+
+def test_index(tmpdir):
+    table = [{'word': 'word{}'.format(index % 50), 'doc_id': index, 'tf_idf': index / 7} for index in range(500)]
+    directory = str(tmpdir.join('index'))
+
+    write_index(table, directory, key='word', partitions=3)
+    with IndexReader(directory) as index:
+        assert index.lookup('word7') == [row for row in table if row['word'] == 'word7']
+        assert index.lookup('missing') == []
+
+        write_index(table[:10], directory, key='word', partitions=2)
+        assert len(index.lookup('word7')) == 10
+        assert index.refresh()
+        assert index.lookup('word7') == [table[7]]
+        assert index.lookup('word17') == []
+
+
+def test_index_memory_limit(tmpdir, monkeypatch):
+    table = [{'word': 'word{}'.format(index % 50), 'doc_id': index, 'tf_idf': index / 7} for index in range(500)]
+    directory = str(tmpdir.join('index'))
+    spills = []
+    spill = gx.ExternalSorter.spill
+    monkeypatch.setattr(gx.ExternalSorter, 'check_interval', 8)
+    monkeypatch.setattr(gx.ExternalSorter, 'spill', lambda sorter: spills.append(sorter.name) or spill(sorter))
+
+    write_index((row for row in table), directory, key='word', partitions=3, memory_limit=2000)
+    with IndexReader(directory) as index:
+        assert index.lookup('word7') == [row for row in table if row['word'] == 'word7']
+        assert index.lookup('word49') == [row for row in table if row['word'] == 'word49']
+    assert spills
+
+
+def test_distinct():
+    table = [{'doc_id': index % 13, 'word': index % 7, 'index': index} for index in range(3000)]
+    etalon = [row for row in table if row['index'] < 91]
+
+    chain = gx.Chain(source='table')
+    chain.add_distinct(['doc_id', 'word'])
+
+    result = chain.run(table=table, profile=True)
+
+    assert result == etalon
+    assert 'strategy: hash' in chain.explain()
+
+
+def test_distinct_sorted():
+    table = [{'doc_id': index % 13, 'word': index % 7, 'index': index} for index in range(3000)]
+    etalon = sorted([row for row in table if row['index'] < 91], key=lambda row: (row['doc_id'], row['word']))
+
+    chain = gx.Chain(source='table')
+    chain.add_sort(['doc_id', 'word'])
+    chain.add_distinct(['doc_id', 'word'])
+
+    result = chain.run(table=table, profile=True)
+
+    assert result == etalon
+    assert 'strategy: sorted' in chain.explain()
+
+
+def test_distinct_approximate():
+    table = [{'doc_id': index % 13, 'word': index % 7, 'index': index} for index in range(3000)]
+    etalon = [row for row in table if row['index'] < 91]
+
+    chain = gx.Chain(source='table')
+    chain.add_distinct(['doc_id', 'word'], approximate=True)
+
+    result = chain.run(table=table)
+
+    assert result == etalon
+
+
+def test_distinct_memory_limit(monkeypatch):
+    table = [{'doc_id': index % 13, 'word': index % 7, 'index': index} for index in range(3000)]
+    etalon = [row for row in table if row['index'] < 91]
+
+    monkeypatch.setattr(gx.SpillSet, 'check_interval', 8)
+    chain = gx.Chain(source='table')
+    chain.add_distinct(['doc_id', 'word'])
+
+    result = chain.run(table=table, memory_limit=2000)
+
+    assert sort_rows(result) == sort_rows(etalon)
+    assert chain.memory_report['consumers']["distinct by ['doc_id', 'word']"]['spills'] > 0